@@ -1,12 +1,12 @@
-import torch, os, logging
+import os, time, logging, atexit
 from urllib.parse import quote as url_quote
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, stream_with_context
 from dotenv import load_dotenv
 from flask_cors import CORS
 from utils.ImageTextSearchEngine import ImageTextSearchEngine
 from utils.Translation import Translation
 from utils.TextProcessor import TextProcessor
-from io import BytesIO
+from utils.Metrics import Metrics
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -24,17 +24,71 @@ db_config = {
     'database': os.getenv('DB_NAME')
 }
 
+startup_start = time.perf_counter()
+
 # Load file bin
 bin_file = 'D:/AIC/model/faiss_normal_ViT.bin'
+metadata_path = 'D:/AIC/model/faiss_normal_ViT_metadata'
+vectors_path = 'D:/AIC/model/faiss_normal_ViT_vectors'
+shards_path = 'D:/AIC/model/faiss_normal_ViT_shards.json'
+manifest_path = 'D:/AIC/model/faiss_normal_ViT_manifest.json'
 
 image_text_search_engine = ImageTextSearchEngine(
     db_config=db_config,
     bin_file=bin_file,
-    translator=Translation(),
-    text_preprocessing=TextProcessor(),
+    translator=Translation(
+        mode=os.getenv('TRANSLATION_MODE', 'deep_translator'),
+        fallback_mode=os.getenv('TRANSLATION_FALLBACK_MODE'),
+        phrase_table=os.getenv('TRANSLATION_PHRASE_TABLE'),
+        latency_budget=float(os.getenv('TRANSLATION_LATENCY_BUDGET', 0)) or None
+    ),
+    text_preprocessing=TextProcessor.natural() if os.getenv('TEXT_PREPROCESSING') == 'natural' else TextProcessor(),
     clip_backbone='ViT-B/32',
-    device='cuda' if torch.cuda.is_available() else 'cpu'
+    # CUDA is hidden above, so torch is not imported just to find that out
+    device=os.getenv('DEVICE', 'cpu'),
+    nprobe=os.getenv('FAISS_NPROBE'),
+    ef_search=os.getenv('FAISS_EF_SEARCH'),
+    metadata_path=metadata_path,
+    vectors_path=vectors_path,
+    db_pool_size=int(os.getenv('DB_POOL_SIZE', 5)),
+    cache_size=int(os.getenv('QUERY_CACHE_SIZE', 10000)),
+    cache_ttl=float(os.getenv('QUERY_CACHE_TTL', 0)) or None,
+    cache_dir=os.getenv('QUERY_CACHE_DIR'),
+    result_ttl=float(os.getenv('RESULT_CACHE_TTL', 600)),
+    prefetch_k=int(os.getenv('RESULT_PREFETCH_K', 0)) or None,
+    multilingual_model=os.getenv('MULTILINGUAL_MODEL'),
+    text_encoder=os.getenv('TEXT_ENCODER', 'clip'),
+    index_mmap=os.getenv('INDEX_MMAP') == '1',
+    clip_backend=os.getenv('CLIP_BACKEND', 'torch'),
+    clip_threads=int(os.getenv('CLIP_THREADS', 0)) or None,
+    clip_onnx_path=os.getenv('CLIP_ONNX_PATH'),
+    batch_max_size=int(os.getenv('TEXT_BATCH_SIZE', 0)) or None,
+    batch_max_wait_ms=float(os.getenv('TEXT_BATCH_WAIT_MS', 5)),
+    # Requests slower than SLOW_REQUEST_SECONDS get their per-stage trace logged (and appended to TRACE_PATH),
+    # for a TRACE_SAMPLE_RATE fraction of them
+    metrics=Metrics(
+        slow_threshold=float(os.getenv('SLOW_REQUEST_SECONDS', 0)) or None,
+        sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', 1)),
+        trace_path=os.getenv('TRACE_PATH')
+    ),
+    # e.g. STAGE_WORKERS=encode=2,search=4,hydrate=8
+    stage_workers={stage: int(workers) for stage, workers in (item.split('=') for item in os.getenv('STAGE_WORKERS', '').split(',') if item)},
+    shards_path=shards_path,
+    manifest_path=manifest_path,
+    shard_workers=int(os.getenv('SHARD_WORKERS', 0)) or None,
+    # For indexes built with insert.py --index-type sq8/fp16/ivf_sq8/ivf_pq: candidates fetched per result, re-ranked exactly
+    rerank_factor=int(os.getenv('RERANK_FACTOR', 0)) or None
 )
+atexit.register(image_text_search_engine.close)
+
+if os.getenv('INDEX_WATCH_INTERVAL'):
+    image_text_search_engine.watch_index(interval=float(os.getenv('INDEX_WATCH_INTERVAL')))
+
+# Models, index and metadata load on first use; warmup loads them now, in the background unless ENGINE_WARMUP=sync
+if os.getenv('ENGINE_WARMUP', 'background') != 'off':
+    image_text_search_engine.warmup(background=os.getenv('ENGINE_WARMUP', 'background') != 'sync')
+
+logging.info(f'Search engine constructed in {time.perf_counter() - startup_start:.2f}s')
 
 # Flask app setup
 app = Flask(__name__)
@@ -44,15 +98,40 @@ CORS(app=app, resources={
     }
 })
 
+# Optional folder/video restriction: folders=1,3-5, child_folders=1-20, videos=L01_V003,L02_V001.
+# Search endpoints also take clusters=collapse (default, one row per near-duplicate cluster) or clusters=expand
+def request_filters():
+    return {name: request.args.get(name) for name in ('folders', 'child_folders', 'videos') if request.args.get(name)}
+
+# 503 until every component is loaded, with per-component load times
+@app.route('/ready', methods=['GET'])
+def ready():
+    readiness = image_text_search_engine.readiness()
+    return jsonify(readiness), 200 if readiness['ready'] else 503
+
+# Prometheus text format; each gunicorn worker reports its own process
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(image_text_search_engine.metrics_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    scheduler = image_text_search_engine.text_scheduler
+    return jsonify({
+        'caches': image_text_search_engine.cache_stats(),
+        'text_batching': scheduler.stats() if scheduler else None
+    }), 200
+
 @app.route('/image-search', methods=['GET'])
 def image_search():
     img_id = int(request.args.get('imgId'))
     k = int(request.args.get('k'))
-    print(img_id)
-    print(k)
+    offset = int(request.args.get('offset', 0))
+    cursor = request.args.get('cursor')
+    logging.debug(f'image-search imgId={img_id} k={k}')
     try:
-        image_paths = image_text_search_engine.search_images_by_id(img_id, k=k)
-        return jsonify({'results': image_paths}), 200
+        page = image_text_search_engine.search_page(image_id=img_id, k=k, offset=offset, cursor=cursor, filters=request_filters(), clusters=request.args.get('clusters'))
+        return jsonify(page), 200
     except Exception as e:
         logging.error(f'Error in image-search: {str(e)}')
         return jsonify({'Error': str(e)}), 500
@@ -61,20 +140,80 @@ def image_search():
 def text_search():
     text = request.args.get('query')
     k = int(request.args.get('k'))
-    print(text)
+    offset = int(request.args.get('offset', 0))
+    cursor = request.args.get('cursor')
+    logging.debug(f'text-search query={text!r} k={k}')
     try:
-        image_paths = image_text_search_engine.search_images_by_text(text, k=k)
-        return jsonify({'results': image_paths}), 200
+        page = image_text_search_engine.search_page(text=text, k=k, offset=offset, cursor=cursor, encoder=request.args.get('encoder'), filters=request_filters(), clusters=request.args.get('clusters'))
+        return jsonify(page), 200
     except Exception as e:
         logging.error(f'Error in text-search: {str(e)}')
         return jsonify({'Error': str(e)}), 500
 
+@app.route('/batch-search', methods=['POST'])
+def batch_search():
+    data = request.json
+    k = int(data.get('k'))
+    try:
+        results = image_text_search_engine.search_many(texts=data.get('texts'), ids=data.get('ids'), k=k, encoder=data.get('encoder'), filters=data.get('filters'), clusters=data.get('clusters'))
+        return jsonify({'results': results}), 200
+    except Exception as e:
+        logging.error(f'Error in batch-search: {str(e)}')
+        return jsonify({'Error': str(e)}), 500
 
-@app.route('/download-csv', methods=['POST'])
-def export_csv():
+# Ranked sequences of frames in one video matching texts in order, e.g. {"texts": ["a man opens a door", "a dog runs out"], "k": 10}
+@app.route('/temporal-search', methods=['POST'])
+def temporal_search():
     data = request.json
-    output = image_text_search_engine.download_csv(data=data)
-    return send_file(output, as_attachment=True, download_name='output.csv', mimetype='text/csv')
+    try:
+        sequences = image_text_search_engine.search_temporal(
+            texts=data.get('texts'),
+            k=int(data.get('k', 10)),
+            candidates=int(data.get('candidates', 1000)),
+            max_gap=int(data.get('max_gap', 250)),
+            encoder=data.get('encoder'),
+            filters=data.get('filters')
+        )
+        return jsonify({'results': sequences}), 200
+    except Exception as e:
+        logging.error(f'Error in temporal-search: {str(e)}')
+        return jsonify({'Error': str(e)}), 500
+
+@app.route('/reload', methods=['POST'])
+def reload():
+    try:
+        return jsonify(image_text_search_engine.reload()), 200
+    except Exception as e:
+        logging.error(f'Error in reload: {str(e)}')
+        return jsonify({'Error': str(e)}), 500
+
+
+# Streams the CSV. The body is either the hydrated result rows, as before, or {"cursor": token} / {"ids": [...]}
+# with an optional "limit"; GET takes cursor and limit as query parameters. A cursor encodes its query, so any
+# gunicorn worker can export it
+@app.route('/download-csv', methods=['GET', 'POST'])
+def export_csv():
+    data = request.json if request.method == 'POST' else request.args
+    try:
+        if isinstance(data, list):
+            rows = data
+        else:
+            limit = int(data['limit']) if data.get('limit') else None
+            ids = data.get('ids')
+            if isinstance(ids, str):
+                ids = [int(image_id) for image_id in ids.split(',') if image_id]
+            ids = image_text_search_engine.export_ids(cursor=data.get('cursor'), ids=ids, limit=limit)
+            rows = image_text_search_engine.iter_rows(ids, clusters=data.get('clusters'))
+    except Exception as e:
+        logging.error(f'Error in download-csv: {str(e)}')
+        return jsonify({'Error': str(e)}), 500
+
+    return Response(
+        stream_with_context(image_text_search_engine.download_csv(rows)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=output.csv'}
+    )
 
+# Development server only; production runs under gunicorn -c gunicorn.conf.py app:app
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=5001)
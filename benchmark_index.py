@@ -0,0 +1,116 @@
+import argparse, time, faiss, numpy as np
+from utils.IndexBuilder import IndexBuilder, set_search_params
+from utils.FeatureStore import FeatureStore
+from utils.VectorStore import VectorStore
+
+FEATURE_PATH = 'D:/AIC/model/assets/features'
+DIM = 768
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Recall@k and latency of approximate indexes against the flat index')
+    parser.add_argument('--index-types', nargs='+', default=['ivf_flat', 'ivf_pq', 'hnsw'], choices=IndexBuilder.INDEX_TYPES)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=1000, help='Number of stored vectors reused as queries')
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--pq-m', type=int, default=64)
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 16, 32, 64])
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--train-size', type=int, default=100000)
+    parser.add_argument('--rerank', type=int, nargs='+', default=[], help='Candidate factors R: fetch k * R from the index, re-rank exactly from the vectors')
+    return parser.parse_args()
+
+
+def load_vectors():
+    feature_store = FeatureStore(FEATURE_PATH)
+    chunks = []
+    for name in feature_store.video_names():
+        vectors = np.asarray(feature_store.load_vectors(name), dtype=np.float32)
+        if vectors.ndim == 2 and vectors.shape[1] == DIM:
+            chunks.append(vectors)
+
+    vectors = np.concatenate(chunks)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors[norms[:, 0] > 0] / norms[norms[:, 0] > 0]
+
+
+def timed_search(index, queries, k):
+    # One query per call, the way the Flask endpoints search
+    latencies = np.empty(len(queries))
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, indices[i] = index.search(queries[i:i + 1], k)
+        latencies[i] = (time.perf_counter() - start) * 1000
+    return indices, latencies
+
+
+def timed_rerank_search(index, store, queries, k, factor):
+    latencies = np.empty(len(queries))
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        distances, candidates = index.search(queries[i:i + 1], k * factor)
+        _, indices[i] = store.rerank(queries[i:i + 1], distances, candidates, k)
+        latencies[i] = (time.perf_counter() - start) * 1000
+    return indices, latencies
+
+
+# Serialized size, about what the index holds in RAM
+def index_megabytes(index):
+    return faiss.serialize_index(index).nbytes / 2 ** 20
+
+
+def recall_at_k(indices, ground_truth):
+    k = ground_truth.shape[1]
+    hits = sum(len(np.intersect1d(row, truth)) for row, truth in zip(indices, ground_truth))
+    return hits / (len(ground_truth) * k)
+
+
+def report(name, indices, latencies, ground_truth):
+    print(f'{name:<32} recall@{ground_truth.shape[1]}={recall_at_k(indices, ground_truth):.4f} '
+          f'p50={np.percentile(latencies, 50):.2f}ms p99={np.percentile(latencies, 99):.2f}ms')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    vectors = load_vectors()
+    ids = np.arange(len(vectors), dtype=np.int64)
+    queries = vectors[np.random.default_rng(0).choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)]
+    print(f'Loaded {len(vectors)} vectors, {len(queries)} queries')
+
+    flat = IndexBuilder(dim=DIM, index_type='flat').build()
+    flat.add_with_ids(vectors, ids)
+    ground_truth, latencies = timed_search(flat, queries, args.k)
+    report('flat', ground_truth, latencies, ground_truth)
+    print(f'flat index {index_megabytes(flat):.1f}MB')
+    # In-memory stand-in for the memory-mapped vector store insert.py writes
+    store = VectorStore(None, ids=ids, vectors=vectors, dim=DIM)
+
+    for index_type in args.index_types:
+        builder = IndexBuilder(dim=DIM, index_type=index_type, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m, train_size=args.train_size)
+        builder.add_training_sample(vectors)
+
+        start = time.perf_counter()
+        index = builder.build()
+        index.add_with_ids(vectors, ids)
+        print(f'Built {builder.factory_string()} in {time.perf_counter() - start:.1f}s, {index_megabytes(index):.1f}MB')
+
+        if index_type == 'hnsw':
+            settings = [{'ef_search': ef} for ef in args.ef_search]
+        elif index_type.startswith('ivf'):
+            settings = [{'nprobe': nprobe} for nprobe in args.nprobe]
+        else:
+            settings = [{}]
+
+        for setting in settings:
+            set_search_params(index, **setting)
+            indices, latencies = timed_search(index, queries, args.k)
+            label = ' '.join([index_type] + [f'{key}={value}' for key, value in setting.items()])
+            report(label, indices, latencies, ground_truth)
+
+            for factor in args.rerank:
+                indices, latencies = timed_rerank_search(index, store, queries, args.k, factor)
+                report(f'{label} rerank={factor}', indices, latencies, ground_truth)
@@ -0,0 +1,74 @@
+import argparse, time, faiss, numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from utils.IndexBuilder import IndexBuilder, set_search_params
+from utils.ShardedIndex import ShardedIndex, shard_of, shard_paths
+from benchmark_index import DIM, load_vectors, timed_search, recall_at_k
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Latency and throughput of the sharded index against shard count and core count')
+    parser.add_argument('--index-type', default='flat', choices=IndexBuilder.INDEX_TYPES)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--cores', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent single-query clients for the throughput run')
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=500, help='Number of stored vectors reused as queries')
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', type=int, default=32)
+    parser.add_argument('--train-size', type=int, default=100000)
+    return parser.parse_args()
+
+
+def build_shards(args, vectors, ids, shard_count):
+    builder = IndexBuilder(dim=DIM, index_type=args.index_type, nlist=max(1, args.nlist // shard_count), train_size=args.train_size)
+    builder.add_training_sample(vectors)
+    trained = builder.build()
+
+    # Hash split; a folder split depends on how many Lxx folders the collection has
+    assignment = shard_of('hash', shard_count, None, ids)
+    indexes = []
+    for shard in range(shard_count):
+        index = faiss.clone_index(trained)
+        index.add_with_ids(vectors[assignment == shard], ids[assignment == shard])
+        set_search_params(index, nprobe=args.nprobe)
+        indexes.append(index)
+    return indexes
+
+
+def throughput(index, queries, k, clients):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(lambda i: index.search(queries[i:i + 1], k), range(len(queries))))
+    return len(queries) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    vectors = load_vectors()
+    ids = np.arange(len(vectors), dtype=np.int64)
+    queries = vectors[np.random.default_rng(0).choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)]
+    print(f'Loaded {len(vectors)} vectors, {len(queries)} queries')
+
+    flat = IndexBuilder(dim=DIM, index_type='flat').build()
+    flat.add_with_ids(vectors, ids)
+    ground_truth = flat.search(queries, args.k)[1]
+    del flat
+
+    for shard_count in args.shards:
+        start = time.perf_counter()
+        indexes = build_shards(args, vectors, ids, shard_count)
+        print(f'Built {shard_count} {args.index_type} shard(s) in {time.perf_counter() - start:.1f}s')
+
+        for cores in args.cores:
+            # Cores are split between the shard threads and faiss' own OpenMP threads inside each shard
+            faiss.omp_set_num_threads(max(1, cores // shard_count))
+            index = ShardedIndex('shards.json', 'hash', shard_paths('shards.json', shard_count), indexes, workers=min(cores, shard_count))
+
+            indices, latencies = timed_search(index, queries, args.k)
+            qps = throughput(index, queries, args.k, args.clients)
+            index.close()
+
+            print(f'shards={shard_count:<3} cores={cores:<3} recall@{args.k}={recall_at_k(indices, ground_truth):.4f} '
+                  f'p50={np.percentile(latencies, 50):.2f}ms p99={np.percentile(latencies, 99):.2f}ms '
+                  f'{qps:.0f} qps with {args.clients} clients')
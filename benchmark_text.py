@@ -0,0 +1,153 @@
+import argparse, json, time, numpy as np
+
+# JSON list of queries, either plain strings or {"query": ..., "relevant": [image ids]}
+QUERIES_PATH = 'D:/AIC/model/assets/benchmark_queries.json'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Text query benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    encoders = subparsers.add_parser('encoders', help='Translate-then-encode CLIP against the multilingual encoder')
+    encoders.add_argument('--queries', default=QUERIES_PATH)
+    encoders.add_argument('--k', type=int, default=100)
+
+    preprocess = subparsers.add_parser('preprocess', help='Per-query cost of the TextProcessor pipeline')
+    preprocess.add_argument('--queries', default=QUERIES_PATH)
+    preprocess.add_argument('--repeat', type=int, default=5)
+
+    backends = subparsers.add_parser('clip-backends', help='CPU latency, throughput and fp32 parity of the CLIP text backends')
+    backends.add_argument('--queries', default=QUERIES_PATH)
+    backends.add_argument('--backends', nargs='+', default=['torch', 'int8', 'onnx'])
+    backends.add_argument('--threads', type=int, default=None)
+    backends.add_argument('--batch-size', type=int, default=32)
+    backends.add_argument('--onnx-path', default=None)
+    backends.add_argument('--min-similarity', type=float, default=0.99, help='Exit non-zero if any embedding falls below this cosine to fp32')
+
+    return parser.parse_args()
+
+
+def load_queries(filepath):
+    with open(filepath, 'r', encoding='utf-8') as file:
+        queries = json.load(file)
+    return [query if isinstance(query, dict) else {'query': query} for query in queries]
+
+
+def percentiles(latencies):
+    return f'p50={np.percentile(latencies, 50):.1f}ms p99={np.percentile(latencies, 99):.1f}ms mean={np.mean(latencies):.1f}ms'
+
+
+def run_encoders(args):
+    # Importing app builds the engine from the same environment as the server
+    from app import image_text_search_engine as engine
+
+    if engine.multilingual_encoder is None:
+        raise SystemExit('Set MULTILINGUAL_MODEL to benchmark the multilingual encoder')
+
+    queries = load_queries(args.queries)
+    encoders = {
+        'clip': engine.encode_with_clip,
+        'multilingual': engine.multilingual_encoder.encode
+    }
+
+    # Encoders are called directly so the embedding cache does not hide their cost
+    results = {}
+    for name, encode in encoders.items():
+        latencies, hits = [], []
+        for query in queries:
+            start = time.perf_counter()
+            embedding = encode([query['query']])
+            latencies.append((time.perf_counter() - start) * 1000)
+            _, indices = engine.index.search(embedding, args.k)
+            hits.append(indices[0])
+        results[name] = hits
+        print(f'{name:<14} encode {percentiles(latencies)}')
+
+    labelled = [i for i, query in enumerate(queries) if query.get('relevant')]
+    for name, hits in results.items():
+        if labelled:
+            recall = np.mean([len(np.intersect1d(hits[i], queries[i]['relevant'])) / len(queries[i]['relevant']) for i in labelled])
+            print(f'{name:<14} recall@{args.k} against labels: {recall:.4f} ({len(labelled)} queries)')
+        overlap = np.mean([len(np.intersect1d(hit, reference)) / args.k for hit, reference in zip(hits, results['clip'])])
+        print(f'{name:<14} overlap@{args.k} with translate-then-encode: {overlap:.4f}')
+
+
+def time_per_query(process, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            process(text)
+    return (time.perf_counter() - start) * 1e6 / (repeat * len(texts))
+
+
+def run_preprocess(args):
+    from utils.TextProcessor import TextProcessor
+
+    texts = [query['query'] for query in load_queries(args.queries)]
+
+    reference = TextProcessor()
+    stepwise = time_per_query(reference.process_stepwise, texts, args.repeat)
+
+    cold = TextProcessor()
+    # Warm the NLTK resources so only the memo tables start empty
+    cold.stop_words, cold.porter_stemmer, cold.wordnet_lemmatizer.lemmatize('warm')
+    first_pass = time_per_query(cold, texts, 1)
+    warm = time_per_query(cold, texts, args.repeat)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        cold.process_batch(texts)
+    batch = (time.perf_counter() - start) * 1e6 / (args.repeat * len(texts))
+
+    natural = time_per_query(TextProcessor.natural(), texts, args.repeat)
+
+    mismatches = sum(reference.process_stepwise(text) != cold(text) for text in texts)
+
+    print(f'{len(texts)} queries, per-query cost')
+    print(f'stepwise (8 passes)        {stepwise:8.1f}us')
+    print(f'single pass, cold memo     {first_pass:8.1f}us')
+    print(f'single pass, warm memo     {warm:8.1f}us')
+    print(f'process_batch              {batch:8.1f}us')
+    print(f'natural (whitespace only)  {natural:8.1f}us')
+    print(f'outputs differing from stepwise: {mismatches}')
+
+
+def run_clip_backends(args):
+    from utils.TextEncoder import ClipTextEncoder
+
+    texts = [query['query'] for query in load_queries(args.queries)]
+    reference = None
+    failed = False
+
+    for backend in args.backends:
+        encoder = ClipTextEncoder(backend=backend, num_threads=args.threads, onnx_path=args.onnx_path)
+        reference = reference or (encoder if backend == 'torch' else ClipTextEncoder(backend='torch', num_threads=args.threads))
+        encoder.encode(texts[:1])
+
+        latencies = []
+        for text in texts:
+            start = time.perf_counter()
+            encoder.encode([text])
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        for batch_start in range(0, len(texts), args.batch_size):
+            encoder.encode(texts[batch_start:batch_start + args.batch_size])
+        throughput = len(texts) / (time.perf_counter() - start)
+
+        similarity = encoder.parity(texts, reference=reference)
+        failed = failed or similarity.min() < args.min_similarity
+        print(f'{backend:<6} single query {percentiles(latencies)}, batch {args.batch_size} {throughput:.1f} queries/s, cosine to fp32 min={similarity.min():.4f} mean={similarity.mean():.4f}')
+
+    if failed:
+        raise SystemExit(f'Embedding parity below {args.min_similarity}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'encoders':
+        run_encoders(args)
+    elif args.command == 'preprocess':
+        run_preprocess(args)
+    elif args.command == 'clip-backends':
+        run_clip_backends(args)
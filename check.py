@@ -1,25 +1,24 @@
 import json, os
+from utils.FeatureStore import FeatureStore
 
-RESULT_PATH = 'D:/AIC/model/assets/results'
+FEATURE_PATH = 'D:/AIC/model/assets/features'
 STORAGE_PATH = 'D:/AIC/model/assets/storage'
 
+feature_store = FeatureStore(FEATURE_PATH)
+video_names = set(feature_store.video_names())
+
 for filename in os.listdir(STORAGE_PATH):
-    result_file = f'{RESULT_PATH}/{filename}'
+    name = os.path.splitext(filename)[0]
     storage_file = f'{STORAGE_PATH}/{filename}'
 
-    result_file_size = os.path.getsize(result_file)
-    storage_file_size = os.path.getsize(storage_file)
-
-    if storage_file_size > result_file_size:
+    if name not in video_names:
         print(f'Error in {filename}')
-    
-    else:
-        with open(result_file, 'r') as file:
-            result = json.load(file)
 
+    else:
         with open(storage_file, 'r') as file:
             storage = json.load(file)
 
-        if(len(storage) != len(result)):
+        # Only the .npy header is read, the vectors stay on disk
+        if(len(storage) != feature_store.count(name)):
             print(f'Error in {filename}')
     
@@ -0,0 +1,19 @@
+import argparse, os
+from utils.FeatureStore import FeatureStore
+
+RESULT_PATH = 'D:/AIC/model/assets/results'
+FEATURE_PATH = 'D:/AIC/model/assets/features'
+
+parser = argparse.ArgumentParser(description='Convert JSON result files into binary per-video feature files')
+parser.add_argument('--source', default=RESULT_PATH)
+parser.add_argument('--target', default=FEATURE_PATH)
+parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'])
+args = parser.parse_args()
+
+feature_store = FeatureStore(args.target, dtype=args.dtype)
+
+for filename in os.listdir(args.source):
+    name = feature_store.convert_json(f'{args.source}/{filename}')
+    print(f'Converted {filename} to {name}.npy ({feature_store.count(name)} frames)')
+
+print('Converted all result files successfully!')
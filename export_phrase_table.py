@@ -0,0 +1,26 @@
+import argparse, os
+from utils.LRUCache import LRUCache
+from utils.Translation import Translation
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export past query translations as a phrase table for TRANSLATION_PHRASE_TABLE')
+    parser.add_argument('--cache-dir', default=os.getenv('QUERY_CACHE_DIR'), help='QUERY_CACHE_DIR of the server, holding translations.pkl')
+    parser.add_argument('--phrase-table', default=os.getenv('TRANSLATION_PHRASE_TABLE'), help='Existing phrase table to merge into the export')
+    parser.add_argument('--max-size', type=int, default=1000000, help='Most recent translations read from the cache')
+    parser.add_argument('--output', required=True)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.cache_dir:
+        raise SystemExit('No --cache-dir given and QUERY_CACHE_DIR is not set; the server only persists translations with a cache dir')
+
+    # The server saves the cache on shutdown; expired entries are skipped when it is read back
+    cache = LRUCache(max_size=args.max_size, persist_path=os.path.join(args.cache_dir, 'translations.pkl'))
+    translations = {key: item[1] for key, item in cache.data.items()}
+
+    translation = Translation(phrase_table=args.phrase_table)
+    translation.export_phrase_table(args.output, translations=translations)
+    print(f'Exported {len(translations)} cached queries and {len(translation.phrase_table)} existing phrases to {args.output}')
@@ -0,0 +1,25 @@
+import os
+
+# gunicorn -c gunicorn.conf.py app:app
+bind = os.getenv('BIND', '0.0.0.0:5001')
+
+# Each worker process has its own engine; with INDEX_MMAP=1 they share the index pages through the page cache
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+
+# Threads per worker accept requests; the engine's stage pools (STAGE_WORKERS) and text batching
+# (TEXT_BATCH_SIZE) bound how many of them run the model or faiss at once
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# The app is imported in each worker rather than preloaded in the master: the engine starts threads
+# (warmup, text batching, index watcher) that would not survive the fork
+preload_app = False
+
+# Lazy loading makes the first requests of a cold worker slow, so allow for the model load
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
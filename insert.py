@@ -1,9 +1,17 @@
-import json, faiss, mysql.connector, os, numpy as np
+import argparse, glob, hashlib, json, shutil, faiss, mysql.connector, os, numpy as np
 from dotenv import load_dotenv
+from utils.IndexBuilder import IndexBuilder
+from utils.MetadataStore import MetadataStore
+from utils.VectorStore import VectorStore
+from utils.FeatureStore import FeatureStore, parse_video_name
+from utils.ShardedIndex import ShardedIndex, shard_of, shard_paths
+from utils.KeyframeClusters import cluster_keyframes
 
 load_dotenv()
 
-FOLDER_PATH = 'D:/AIC/model/assets/results'
+FEATURE_PATH = 'D:/AIC/model/assets/features'
+BIN_FILE = 'D:/AIC/model/faiss_normal_ViT.bin'
+DIM = 768
 
 db_config = {
     'host': os.getenv('DB_HOST'),
@@ -12,44 +20,428 @@ db_config = {
     'database': os.getenv('DB_NAME')
 }
 
-db_connection = mysql.connector.connect(**db_config)
-db_cursor = db_connection.cursor()
 
-index = faiss.IndexIDMap(faiss.IndexFlatIP(768))
+def parse_args():
+    parser = argparse.ArgumentParser(description='Insert keyframe features into MySQL and build the faiss index')
+    parser.add_argument('--index-type', default=os.getenv('INDEX_TYPE', 'flat'), choices=IndexBuilder.INDEX_TYPES)
+    parser.add_argument('--nlist', type=int, default=1024, help='Number of IVF cells')
+    parser.add_argument('--pq-m', type=int, default=64, help='Number of PQ sub-quantizers')
+    parser.add_argument('--pq-nbits', type=int, default=8, help='Bits per PQ code')
+    parser.add_argument('--hnsw-m', type=int, default=32, help='HNSW neighbours per node')
+    parser.add_argument('--ef-construction', type=int, default=200)
+    parser.add_argument('--train-size', type=int, default=100000, help='Number of vectors sampled for training')
+    parser.add_argument('--insert-batch', type=int, default=1000, help='Rows per executemany INSERT')
+    parser.add_argument('--add-chunk', type=int, default=65536, help='Vectors buffered per faiss add_with_ids call')
+    parser.add_argument('--commit-every', type=int, default=50000, help='Rows inserted between commits')
+    parser.add_argument('--shards', type=int, default=1, help='Write N index shards searched in parallel by the server instead of one index')
+    parser.add_argument('--shard-by', default='folder', choices=ShardedIndex.SHARD_BY, help='Keep each Lxx folder in one shard, or spread ids by hash')
+    parser.add_argument('--dedup-threshold', type=float, default=None, help='Cosine similarity at which consecutive keyframes of a video are clustered, with only one representative per cluster indexed')
+    parser.add_argument('--dedup-max-gap', type=int, default=None, help='Largest frame_mapping_index gap between two keyframes of one cluster')
+    parser.add_argument('--incremental', action='store_true', help='Append new or changed videos to the existing index instead of rebuilding it')
+    parser.add_argument('--output', default=BIN_FILE)
+    return parser.parse_args()
 
-for filename in os.listdir(FOLDER_PATH):
-    arr_id = filename.split('_')
-    folder_id = int(arr_id[0].replace('L0', '').replace('L', ''))
-    child_folder_id = int(arr_id[1].replace('V0', '').replace('V', ''))
 
-    filepath = f'{FOLDER_PATH}/{filename}'
-    with open(filepath, 'r') as file:
-        listData = json.load(file)
+def metadata_path(bin_file):
+    return f'{os.path.splitext(bin_file)[0]}_metadata'
 
-    insert_img_features_sql = "INSERT INTO image_features (folder_id, child_folder_id, id_frame, image_path, frame_mapping_index, vector_features) VALUES (%s, %s, %s, %s, %s, %s)"
 
-    for key, entry in listData.items():
-        vector_features = np.array(entry['vector_feature'], dtype=np.float32)
-        if vector_features.ndim == 1:
-            vector_features = vector_features.reshape(1, -1)
-        norms = np.linalg.norm(vector_features, axis=1, keepdims=True)
-        if vector_features.shape[1] != 768 or norms == 0:
-            print(f"Error: Vector feature in {filename} (key: {key}) has incorrect dimension: {vector_features.shape}")
+def vectors_path(bin_file):
+    return f'{os.path.splitext(bin_file)[0]}_vectors'
+
+
+def manifest_path(bin_file):
+    return f'{os.path.splitext(bin_file)[0]}_manifest.json'
+
+
+def shards_path(bin_file):
+    return f'{os.path.splitext(bin_file)[0]}_shards.json'
+
+
+def file_checksum(feature_store, name):
+    sha1 = hashlib.sha1()
+    for filepath in (feature_store.vectors_file(name), feature_store.meta_file(name)):
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# Videos by name, the next unused id, which only ever grows so ids of removed videos are never handed out again,
+# and the store directories in use, named relative to the index folder
+def load_manifest(bin_file):
+    manifest = {
+        'next_id': 0,
+        'videos': {},
+        'version': 0,
+        'stores': {'metadata': os.path.basename(metadata_path(bin_file)), 'vectors': os.path.basename(vectors_path(bin_file))}
+    }
+    try:
+        with open(manifest_path(bin_file), 'r') as file:
+            stored = json.load(file)
+    except FileNotFoundError:
+        return manifest
+    # Older manifests are the bare videos dict
+    if 'videos' not in stored:
+        stored = {'videos': stored, 'next_id': max((entry['first_id'] + entry['count'] for entry in stored.values()), default=0)}
+    manifest.update(stored)
+    return manifest
+
+
+def store_paths(bin_file, manifest):
+    folder = os.path.dirname(metadata_path(bin_file))
+    return os.path.join(folder, manifest['stores']['metadata']), os.path.join(folder, manifest['stores']['vectors'])
+
+
+# Compacted stores are copied into a new {name}.{version} directory instead of being replaced in place
+def next_store_version(bin_file, manifest):
+    manifest['version'] += 1
+    manifest['stores'] = {
+        'metadata': f'{os.path.basename(metadata_path(bin_file))}.{manifest["version"]}',
+        'vectors': f'{os.path.basename(vectors_path(bin_file))}.{manifest["version"]}'
+    }
+    return store_paths(bin_file, manifest)
+
+
+# Store directories the manifest no longer points at: older versions, and copies a failed run left half-written.
+# Removed at the start of the next run, by which time the server has moved off them.
+def remove_stale_stores(bin_file, manifest):
+    current = {os.path.normpath(path) for path in store_paths(bin_file, manifest)}
+    for base in (metadata_path(bin_file), vectors_path(bin_file)):
+        for path in [base] + glob.glob(f'{glob.escape(base)}.*'):
+            if os.path.isdir(path) and os.path.normpath(path) not in current:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+# Largest id in an id column of the metadata or vector store, 0 when there is none
+def stored_max_id(filepath):
+    if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+        return 0
+    return int(np.fromfile(filepath, dtype='<i8').max())
+
+
+# Write next to the target and rename over it, so the server never reads a half-written file
+def write_index_atomically(filepath, index):
+    tmp_file = f'{filepath}.tmp'
+    faiss.write_index(index, tmp_file)
+    os.replace(tmp_file, filepath)
+
+
+def write_indexes(bin_file, indexes, shard_by, dirty=None):
+    if len(indexes) == 1:
+        write_index_atomically(bin_file, indexes[0])
+        # A single index replaces any earlier sharded build
+        if os.path.exists(shards_path(bin_file)):
+            os.remove(shards_path(bin_file))
+    else:
+        # Only shards that changed are rewritten, so the server reloads just those
+        paths = shard_paths(shards_path(bin_file), len(indexes))
+        for i, (path, index) in enumerate(zip(paths, indexes)):
+            if dirty is None or i in dirty:
+                write_index_atomically(path, index)
+        ShardedIndex.write_layout(shards_path(bin_file), shard_by, paths)
+
+
+# Written last, once the index is: a run that fails before this leaves the previous manifest, and the next
+# run cleans up every id it handed out past that manifest's next_id
+def write_manifest(bin_file, manifest):
+    with open(f'{manifest_path(bin_file)}.tmp', 'w') as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(f'{manifest_path(bin_file)}.tmp', manifest_path(bin_file))
+
+
+def read_indexes(bin_file):
+    if os.path.exists(shards_path(bin_file)):
+        with open(shards_path(bin_file), 'r') as file:
+            layout = json.load(file)
+        folder = os.path.dirname(shards_path(bin_file))
+        return [faiss.read_index(os.path.join(folder, filename)) for filename in layout['shards']], layout['shard_by']
+    return [faiss.read_index(bin_file)], 'folder'
+
+
+def normalize_vectors(name, file_vectors):
+    # One vectorized pass per file; rows with the wrong shape or a zero norm are reported and dropped
+    vectors = np.asarray(file_vectors, dtype=np.float32)
+    if vectors.ndim != 2 or vectors.shape[1] != DIM:
+        print(f'Error: Vector features in {name} have incorrect dimension: {vectors.shape}')
+        return np.zeros(len(vectors), dtype=bool), np.empty((0, DIM), dtype=np.float32)
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    valid = norms[:, 0] > 0
+    if not valid.all():
+        print(f'Error: {int((~valid).sum())} zero vectors in {name} skipped')
+
+    return valid, vectors[valid] / norms[valid]
+
+
+def collect_training_sample(builder, feature_store):
+    for name in feature_store.video_names():
+        _, normalized = normalize_vectors(name, feature_store.load_vectors(name))
+        builder.add_training_sample(normalized)
+
+    print(f'Sampled {builder.sample_count} of {builder.seen} vectors for training')
+
+
+class BulkIngestor:
+    INSERT_SQL = "INSERT INTO image_features (id, folder_id, child_folder_id, id_frame, image_path, frame_mapping_index, vector_features) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+
+    def __init__(self, db_connection, indexes, metadata, vector_store, shard_by='folder', insert_batch=1000, add_chunk=65536, commit_every=50000, dedup_threshold=None, dedup_max_gap=None, next_id=0):
+        self.db_connection = db_connection
+        self.db_cursor = db_connection.cursor()
+        # One index, or the shards of a sharded build; shard_by decides which shard a vector goes to
+        self.indexes = indexes
+        self.shard_by = shard_by
+        self.dirty = set()
+        self.metadata = metadata
+        self.vector_store = vector_store
+        self.insert_batch = insert_batch
+        self.add_chunk = add_chunk
+        self.commit_every = commit_every
+        self.dedup_threshold = dedup_threshold
+        self.dedup_max_gap = dedup_max_gap
+
+        # Ids are assigned here rather than read back one lastrowid at a time, past every id MySQL, the stores
+        # or the manifest (next_id) have seen, so a removed video's ids are not reused
+        self.db_cursor.execute("SELECT COALESCE(MAX(id), 0) FROM image_features")
+        self.next_id = max(
+            int(self.db_cursor.fetchone()[0]),
+            stored_max_id(os.path.join(metadata.path, 'id.bin')),
+            stored_max_id(os.path.join(vector_store.path, 'ids.bin'))
+        ) + 1
+        self.next_id = max(self.next_id, next_id)
+        # Inclusive id ranges removed from the index and MySQL, dropped from the stores by compact()
+        self.removed = []
+
+        self.pending = [([], []) for _ in indexes]
+        self.pending_count = 0
+        self.uncommitted = 0
+        self.total = 0
+
+    def ingest(self, name, meta, file_vectors):
+        folder_id, child_folder_id = parse_video_name(name)
+        valid, normalized = normalize_vectors(name, file_vectors)
+        rows = np.flatnonzero(valid)
+        if self.dedup_threshold:
+            # Ids follow frame order, so the members of every cluster get consecutive ids
+            order = np.argsort([meta['frame_index'][i] for i in rows], kind='stable')
+            rows, normalized = rows[order], normalized[order]
+        ids = np.arange(self.next_id, self.next_id + len(rows), dtype=np.int64)
+        self.next_id += len(rows)
+
+        keys = [meta['keys'][i] for i in rows]
+        urls = [meta['url'][i] for i in rows]
+        frame_indices = [meta['frame_index'][i] for i in rows]
+
+        for start in range(0, len(rows), self.insert_batch):
+            end = start + self.insert_batch
+            self.db_cursor.executemany(self.INSERT_SQL, [
+                (int(image_id), folder_id, child_folder_id, key, url, frame_index, vector.tobytes())
+                for image_id, key, url, frame_index, vector in zip(ids[start:end], keys[start:end], urls[start:end], frame_indices[start:end], normalized[start:end])
+            ])
+
+        # Every keyframe stays in MySQL, the metadata and the vector store; the index holds one per cluster
+        if self.dedup_threshold:
+            labels, representatives = cluster_keyframes(normalized, frame_indices, self.dedup_threshold, max_gap=self.dedup_max_gap)
+            cluster_ids = ids[representatives][labels]
+        else:
+            representatives, cluster_ids = slice(None), ids
+
+        self.metadata.append(ids, [folder_id] * len(ids), [child_folder_id] * len(ids), keys, urls, frame_indices, cluster_ids)
+        self.vector_store.append(ids, normalized)
+        self.add(folder_id, ids[representatives], normalized[representatives])
+
+        self.uncommitted += len(ids)
+        self.total += len(ids)
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+        return ids
+
+    def add(self, folder_id, ids, vectors):
+        shards = shard_of(self.shard_by, len(self.indexes), folder_id, ids)
+        for shard in np.unique(shards):
+            rows = shards == shard
+            self.pending[shard][0].append(ids[rows])
+            self.pending[shard][1].append(vectors[rows])
+            self.dirty.add(int(shard))
+
+        self.pending_count += len(ids)
+        if self.pending_count >= self.add_chunk:
+            self.flush()
+
+    def flush(self):
+        for index, (pending_ids, pending_vectors) in zip(self.indexes, self.pending):
+            if pending_ids:
+                index.add_with_ids(np.vstack(pending_vectors), np.concatenate(pending_ids))
+        self.pending = [([], []) for _ in self.indexes]
+        self.pending_count = 0
+
+    @property
+    def ntotal(self):
+        return sum(index.ntotal for index in self.indexes)
+
+    def remove(self, first_id, count):
+        # Ids of one video are contiguous, so a range selector covers them
+        if count == 0:
+            return
+        self.flush()
+        try:
+            for shard, index in enumerate(self.indexes):
+                if index.remove_ids(faiss.IDSelectorRange(first_id, first_id + count)):
+                    self.dirty.add(shard)
+        except RuntimeError as e:
+            raise RuntimeError(f'This index type cannot remove ids, rebuild it without --incremental: {e}') from e
+        self.db_cursor.execute("DELETE FROM image_features WHERE id BETWEEN %s AND %s", (first_id, first_id + count - 1))
+        self.removed.append((first_id, first_id + count - 1))
+
+    # The stores are append-only while ingesting; removed rows are cut out once at the end by copying the
+    # stores into the target directories
+    def compact(self, metadata_target, vectors_target):
+        dropped = MetadataStore.compact(self.metadata.path, metadata_target, self.removed)
+        VectorStore.compact(self.vector_store.path, vectors_target, self.removed, dim=self.vector_store.dim)
+        return dropped
+
+    def commit(self):
+        self.db_connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        self.commit()
+        self.db_cursor.close()
+
+
+def build(args, feature_store, db_connection):
+    builder = IndexBuilder(
+        dim=DIM,
+        index_type=args.index_type,
+        nlist=args.nlist,
+        pq_m=args.pq_m,
+        pq_nbits=args.pq_nbits,
+        hnsw_m=args.hnsw_m,
+        ef_construction=args.ef_construction,
+        train_size=args.train_size
+    )
+
+    if builder.needs_training():
+        collect_training_sample(builder, feature_store)
+
+    index = builder.build()
+    # Shards are clones of the trained empty index, so IVF shards share one coarse quantizer
+    indexes = [index] + [faiss.clone_index(index) for _ in range(args.shards - 1)]
+    print(f'Building {builder.factory_string()} index' + (f' in {args.shards} shards by {args.shard_by}' if args.shards > 1 else ''))
+    if args.index_type in IndexBuilder.COMPRESSED_TYPES:
+        print(f'{args.index_type} scores are approximate; serve with RERANK_FACTOR set to re-rank from the vector store')
+
+    # A fresh build goes into a new store version, so the stores the server has mapped are left alone
+    manifest = load_manifest(args.output)
+    remove_stale_stores(args.output, manifest)
+    metadata_dir, vectors_dir = next_store_version(args.output, manifest)
+
+    ingestor = BulkIngestor(
+        db_connection,
+        indexes,
+        MetadataStore.create(metadata_dir),
+        VectorStore.create(vectors_dir, dim=DIM),
+        shard_by=args.shard_by,
+        insert_batch=args.insert_batch,
+        add_chunk=args.add_chunk,
+        commit_every=args.commit_every,
+        dedup_threshold=args.dedup_threshold,
+        dedup_max_gap=args.dedup_max_gap,
+        next_id=manifest['next_id']
+    )
+
+    videos = {}
+    for filename in feature_store.video_names():
+        meta, file_vectors = feature_store.load(filename)
+        ids = ingestor.ingest(filename, meta, file_vectors)
+        videos[filename] = {'checksum': file_checksum(feature_store, filename), 'first_id': int(ids[0]) if len(ids) else 0, 'count': len(ids)}
+        print(f'Inserted {len(ids)} entries in {filename} successfully')
+
+    ingestor.close()
+    print(f'Inserted {ingestor.total} entries in total, {ingestor.ntotal} indexed')
+
+    write_indexes(args.output, indexes, args.shard_by)
+    manifest.update(videos=videos, next_id=ingestor.next_id)
+    write_manifest(args.output, manifest)
+
+
+def update(args, feature_store, db_connection):
+    # The shard count and shard_by of an existing build are kept
+    indexes, shard_by = read_indexes(args.output)
+    manifest = load_manifest(args.output)
+    videos = manifest['videos']
+    remove_stale_stores(args.output, manifest)
+    metadata_dir, vectors_dir = store_paths(args.output, manifest)
+    os.makedirs(metadata_dir, exist_ok=True)
+    os.makedirs(vectors_dir, exist_ok=True)
+
+    ingestor = BulkIngestor(
+        db_connection,
+        indexes,
+        MetadataStore(metadata_dir),
+        VectorStore(vectors_dir, dim=DIM),
+        shard_by=shard_by,
+        insert_batch=args.insert_batch,
+        add_chunk=args.add_chunk,
+        commit_every=args.commit_every,
+        dedup_threshold=args.dedup_threshold,
+        dedup_max_gap=args.dedup_max_gap,
+        next_id=manifest['next_id']
+    )
+
+    # Ids past the manifest's next_id belong to a run that failed before writing its manifest. The ingestor
+    # already starts past them, so they are not reused; their rows are removed like those of a deleted video.
+    orphaned = ingestor.next_id - manifest['next_id']
+    if manifest['next_id'] and orphaned > 0:
+        ingestor.remove(manifest['next_id'], orphaned)
+        print(f'Removed ids {manifest["next_id"]}-{ingestor.next_id - 1} left by an interrupted run')
+
+    video_names = feature_store.video_names()
+    removed = 0
+
+    # Videos whose feature files were deleted
+    for filename in set(videos) - set(video_names):
+        entry = videos.pop(filename)
+        ingestor.remove(entry['first_id'], entry['count'])
+        removed += entry['count']
+        print(f'Removed {entry["count"]} stale entries of {filename}')
+
+    for filename in video_names:
+        checksum = file_checksum(feature_store, filename)
+        entry = videos.get(filename)
+        if entry and entry['checksum'] == checksum:
             continue
 
-        normalized_vector = vector_features / norms
-        vector_blob = normalized_vector.tobytes()
+        if entry:
+            ingestor.remove(entry['first_id'], entry['count'])
+            removed += entry['count']
+
+        meta, file_vectors = feature_store.load(filename)
+        ids = ingestor.ingest(filename, meta, file_vectors)
+        videos[filename] = {'checksum': checksum, 'first_id': int(ids[0]) if len(ids) else 0, 'count': len(ids)}
+        print(f'{"Updated" if entry else "Inserted"} {len(ids)} entries in {filename} successfully')
+
+    ingestor.close()
+    # Removed rows are dropped by copying the stores into a new version, which the manifest switches to. The
+    # stores the server has mapped are never rewritten, and are removed by the next run.
+    dropped = ingestor.compact(*next_store_version(args.output, manifest)) if ingestor.removed else 0
+    print(f'Inserted {ingestor.total} and removed {removed} entries, index now holds {ingestor.ntotal}, {dropped} stale rows dropped from the stores')
 
-        db_cursor.execute(insert_img_features_sql, (folder_id, child_folder_id, key, entry['url'], entry['frame_index'], vector_blob))
-        image_id = db_cursor.lastrowid
+    write_indexes(args.output, indexes, shard_by, dirty=ingestor.dirty)
+    manifest['next_id'] = ingestor.next_id
+    write_manifest(args.output, manifest)
 
-        index.add_with_ids(normalized_vector, np.array([image_id], dtype=np.int64))
-        
-    print(f'Inserted all entries in {filename} successfully')
 
-db_connection.commit()
+if __name__ == '__main__':
+    args = parse_args()
+    feature_store = FeatureStore(FEATURE_PATH)
+    db_connection = mysql.connector.connect(**db_config)
 
-faiss.write_index(index, "D:/AIC/model/faiss_normal_ViT.bin")
+    if args.incremental and (os.path.exists(args.output) or os.path.exists(shards_path(args.output))):
+        update(args, feature_store, db_connection)
+    else:
+        build(args, feature_store, db_connection)
 
-db_cursor.close()
-db_connection.close()
\ No newline at end of file
+    db_connection.close()
@@ -0,0 +1,108 @@
+import argparse, json, time, threading, urllib.error, urllib.parse, urllib.request, numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# JSON list of queries, either plain strings or {"query": ...}, same format as benchmark_text.py
+QUERIES_PATH = 'D:/AIC/model/assets/benchmark_queries.json'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Closed-loop load test of the search API')
+    parser.add_argument('--url', default='http://localhost:5001')
+    parser.add_argument('--endpoint', default='text-search', choices=['text-search', 'image-search', 'download-csv'])
+    parser.add_argument('--queries', default=QUERIES_PATH)
+    parser.add_argument('--image-ids', type=int, nargs='+', default=list(range(1, 101)), help='imgId values for image-search')
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--duration', type=float, default=30, help='Seconds per concurrency level')
+    parser.add_argument('--timeout', type=float, default=60)
+    return parser.parse_args()
+
+
+def load_queries(filepath):
+    with open(filepath, 'r', encoding='utf-8') as file:
+        queries = json.load(file)
+    return [query['query'] if isinstance(query, dict) else query for query in queries]
+
+
+def image_search_request(args, image_id):
+    return urllib.request.Request(f'{args.url}/image-search?' + urllib.parse.urlencode({'imgId': image_id, 'k': args.k}))
+
+
+def make_requests(args):
+    if args.endpoint == 'text-search':
+        return [urllib.request.Request(f'{args.url}/text-search?' + urllib.parse.urlencode({'query': query, 'k': args.k})) for query in load_queries(args.queries)]
+    if args.endpoint == 'image-search':
+        return [image_search_request(args, image_id) for image_id in args.image_ids]
+
+    # The export body is k real result rows, fetched once
+    with urllib.request.urlopen(image_search_request(args, args.image_ids[0]), timeout=args.timeout) as response:
+        body = json.dumps(json.load(response)['results']).encode('utf-8')
+    return [urllib.request.Request(f'{args.url}/download-csv', data=body, headers={'Content-Type': 'application/json'}, method='POST')]
+
+
+# Lazy loading means a fresh server answers /ready with 503 until the models and index are in
+def wait_until_ready(args):
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(f'{args.url}/ready', timeout=args.timeout):
+                return
+        except (urllib.error.URLError, OSError):
+            time.sleep(1)
+    raise SystemExit(f'{args.url} not ready after {args.timeout:.0f}s')
+
+
+def send(request, timeout):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+# Each client sends its next request as soon as the previous one returns
+def run_level(requests, concurrency, duration, timeout):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(offset):
+        nonlocal errors
+        i = offset
+        while time.perf_counter() < deadline:
+            latency, ok = send(requests[i % len(requests)], timeout)
+            with lock:
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+            i += concurrency
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return np.array(latencies) * 1000, errors, elapsed
+
+
+def report(concurrency, latencies, errors, elapsed):
+    if len(latencies) == 0:
+        print(f'{concurrency:>5} {"-":>8} {"-":>8} {"-":>8} {"-":>8} {errors:>7}')
+        return
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f'{concurrency:>5} {len(latencies) / elapsed:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {errors:>7}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    wait_until_ready(args)
+    requests = make_requests(args)
+
+    print(f'{args.endpoint}, {args.duration:.0f}s per level, latencies in ms')
+    print(f'{"conc":>5} {"rps":>8} {"p50":>8} {"p95":>8} {"p99":>8} {"errors":>7}')
+    for concurrency in args.concurrency:
+        report(concurrency, *run_level(requests, concurrency, args.duration, args.timeout))
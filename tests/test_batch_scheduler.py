@@ -0,0 +1,35 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from utils.BatchScheduler import BatchScheduler
+
+
+class BatchSchedulerTest(unittest.TestCase):
+    def test_failing_item_only_fails_its_own_caller(self):
+        def handler(items):
+            if '2024' in items:
+                raise ValueError(f'bad query in {items}')
+            return [item.upper() for item in items]
+
+        scheduler = BatchScheduler(handler, max_batch_size=4, max_wait_ms=200, name='test')
+        try:
+            queries = ['a red car', 'a dog', '2024', 'people walking']
+            futures = [scheduler.submit(query) for query in queries]
+
+            self.assertEqual([futures[i].result(timeout=5) for i in (0, 1, 3)], ['A RED CAR', 'A DOG', 'PEOPLE WALKING'])
+            with self.assertRaises(ValueError):
+                futures[2].result(timeout=5)
+            self.assertEqual(scheduler.stats()['split_batches'], 1)
+        finally:
+            scheduler.close()
+
+    def test_concurrent_callers_get_their_own_results(self):
+        scheduler = BatchScheduler(lambda items: [item * 2 for item in items], max_batch_size=8, max_wait_ms=5, name='test')
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                self.assertEqual(list(executor.map(scheduler, range(32))), [i * 2 for i in range(32)])
+        finally:
+            scheduler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
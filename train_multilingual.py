@@ -0,0 +1,66 @@
+import argparse, csv, torch, numpy as np
+from torch.utils.data import DataLoader
+from sentence_transformers import SentenceTransformer, InputExample, losses
+from transformers import CLIPModel, CLIPTokenizer
+
+# Tab-separated English / Vietnamese sentence pairs, e.g. translated query logs and captions
+PARALLEL_PATH = 'D:/AIC/model/assets/parallel_en_vi.tsv'
+OUTPUT_PATH = 'D:/AIC/model/multilingual-clip-vit-l14'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Distill a multilingual student into the CLIP ViT-L/14 text embedding space')
+    parser.add_argument('--parallel', default=PARALLEL_PATH)
+    parser.add_argument('--student', default='sentence-transformers/paraphrase-multilingual-mpnet-base-v2')
+    parser.add_argument('--output', default=OUTPUT_PATH)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--warmup-steps', type=int, default=1000)
+    return parser.parse_args()
+
+
+def read_parallel(filepath):
+    with open(filepath, 'r', encoding='utf-8') as file:
+        return [(row[0], row[1]) for row in csv.reader(file, delimiter='\t') if len(row) >= 2]
+
+
+def teacher_embeddings(sentences, batch_size, device):
+    clip_model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14").to(device).eval()
+    clip_tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
+
+    embeddings = []
+    for start in range(0, len(sentences), batch_size):
+        text_tokenized = clip_tokenizer(sentences[start:start + batch_size], padding=True, truncation=True, return_tensors='pt').to(device)
+        with torch.no_grad():
+            text_features = clip_model.get_text_features(**text_tokenized).cpu().numpy()
+        embeddings.append(text_features / np.linalg.norm(text_features, axis=1, keepdims=True))
+
+    return np.vstack(embeddings).astype(np.float32)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    pairs = read_parallel(args.parallel)
+    print(f'Loaded {len(pairs)} sentence pairs')
+
+    # Both the English source and its Vietnamese translation are pulled onto the teacher's English embedding
+    targets = teacher_embeddings([english for english, _ in pairs], args.batch_size, device)
+    examples = []
+    for (english, vietnamese), target in zip(pairs, targets):
+        examples.append(InputExample(texts=[english], label=target))
+        examples.append(InputExample(texts=[vietnamese], label=target))
+
+    student = SentenceTransformer(args.student, device=device)
+    if student.get_sentence_embedding_dimension() != targets.shape[1]:
+        raise ValueError(f'{args.student} produces {student.get_sentence_embedding_dimension()}-d embeddings, the teacher {targets.shape[1]}-d')
+
+    train_dataloader = DataLoader(examples, shuffle=True, batch_size=args.batch_size)
+    student.fit(
+        train_objectives=[(train_dataloader, losses.MSELoss(model=student))],
+        epochs=args.epochs,
+        warmup_steps=args.warmup_steps,
+        output_path=args.output
+    )
+    print(f'Saved multilingual encoder to {args.output}')
@@ -0,0 +1,105 @@
+import queue, threading, time
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    # Collects concurrent requests for up to max_wait_ms or max_batch_size items and runs them as one
+    # handler call; handler maps a list of items to a list of results in the same order
+    def __init__(self, handler, max_batch_size=32, max_wait_ms=5, name='batch'):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.max_queue_depth = 0
+        self.batches = 0
+        self.items = 0
+        self.wait_seconds = 0.0
+        self.split_batches = 0
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, name=f'{name}-scheduler', daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        if self.closed:
+            raise RuntimeError(f'{self.name} scheduler is closed')
+        future = Future()
+        self.queue.put((item, future, time.perf_counter()))
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    # Blocks for the first request, then gathers more until the batch is full or max_wait has passed
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                # Whatever is already queued joins the batch even after the deadline
+                request = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _execute(self, batch):
+        started = time.perf_counter()
+        futures = [future for _, future, _ in batch]
+        try:
+            results = self.handler([item for item, _, _ in batch])
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        except Exception as e:
+            if len(batch) == 1:
+                futures[0].set_exception(e)
+            else:
+                # One bad item must not fail its neighbours: rerun each on its own so every caller
+                # gets its own result or its own exception
+                for item, future, _ in batch:
+                    try:
+                        future.set_result(self.handler([item])[0])
+                    except Exception as item_error:
+                        future.set_exception(item_error)
+                with self.lock:
+                    self.split_batches += 1
+
+        with self.lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.wait_seconds += sum(started - queued_at for _, _, queued_at in batch)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            if batch:
+                self._execute(batch)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+                'mean_wait_ms': 1000 * self.wait_seconds / self.items if self.items else 0.0,
+                'split_batches': self.split_batches
+            }
+
+    def close(self):
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,122 @@
+import queue, logging, threading, time, mysql.connector
+from contextlib import contextmanager
+from mysql.connector import errors
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePool:
+    # Errors after which a connection is dropped instead of going back to the pool
+    CONNECTION_ERRORS = (errors.InterfaceError, errors.OperationalError)
+
+    def __init__(self, db_config, pool_size=5, checkout_timeout=10, reconnect_attempts=3, reconnect_delay=1):
+        self.db_config = db_config
+        self.pool_size = pool_size
+        self.checkout_timeout = checkout_timeout
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        for attempt in range(self.reconnect_attempts):
+            try:
+                # The pool only reads; with autocommit every query sees rows insert.py committed since,
+                # instead of the REPEATABLE READ snapshot of the connection's first query
+                return mysql.connector.connect(**{'autocommit': True, **self.db_config})
+            except self.CONNECTION_ERRORS as e:
+                logger.error(f'Error connecting to MySQL (attempt {attempt + 1}/{self.reconnect_attempts}): {e}')
+                if attempt + 1 == self.reconnect_attempts:
+                    raise
+                time.sleep(self.reconnect_delay)
+
+    def _acquire(self):
+        try:
+            connection = self.pool.get_nowait()
+        except queue.Empty:
+            # Open connections lazily up to pool_size, then wait for one to be returned
+            with self.lock:
+                can_create = self.created < self.pool_size
+                if can_create:
+                    self.created += 1
+            if can_create:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+            try:
+                connection = self.pool.get(timeout=self.checkout_timeout)
+            except queue.Empty:
+                raise TimeoutError(f'No MySQL connection available after {self.checkout_timeout}s (pool size {self.pool_size})')
+
+        # Health check on checkout, reopening the session if the server dropped it
+        try:
+            connection.ping(reconnect=True, attempts=self.reconnect_attempts, delay=self.reconnect_delay)
+        except self.CONNECTION_ERRORS:
+            self._discard(connection)
+            return self._acquire()
+        return connection
+
+    def _release(self, connection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            self._discard(connection)
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        self._forget()
+
+    def _forget(self):
+        with self.lock:
+            self.created -= 1
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        except self.CONNECTION_ERRORS:
+            self._discard(connection)
+            raise
+        except Exception:
+            self._release(connection)
+            raise
+        else:
+            self._release(connection)
+
+    @contextmanager
+    def cursor(self, buffered=True):
+        with self.connection() as connection:
+            cursor = connection.cursor(buffered=buffered)
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    # Read-only helpers, retried once on a fresh connection if the first one turns out dead
+    def fetchall(self, sql, params=None):
+        return self._retry(lambda cursor: cursor.execute(sql, params) or cursor.fetchall())
+
+    def fetchone(self, sql, params=None):
+        return self._retry(lambda cursor: cursor.execute(sql, params) or cursor.fetchone())
+
+    def _retry(self, query):
+        try:
+            with self.cursor() as cursor:
+                return query(cursor)
+        except self.CONNECTION_ERRORS:
+            with self.cursor() as cursor:
+                return query(cursor)
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self.pool.get_nowait())
+            except queue.Empty:
+                break
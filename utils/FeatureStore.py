@@ -0,0 +1,85 @@
+import os, json, numpy as np
+
+
+def parse_video_name(name):
+    # 'L01_V001' (optionally with an extension) -> (1, 1)
+    arr_id = os.path.splitext(os.path.basename(name))[0].split('_')
+    folder_id = int(arr_id[0].replace('L', ''))
+    child_folder_id = int(arr_id[1].replace('V', ''))
+    return folder_id, child_folder_id
+
+
+class FeatureStore:
+    # One video per pair of files: {name}.npy holds the (n, dim) matrix, {name}.meta.json the per-row
+    # frame key, url and frame_index in the same order
+    def __init__(self, folder, dtype='float32'):
+        self.folder = folder
+        self.dtype = np.dtype(dtype)
+        os.makedirs(folder, exist_ok=True)
+
+    def vectors_file(self, name):
+        return os.path.join(self.folder, f'{name}.npy')
+
+    def meta_file(self, name):
+        return os.path.join(self.folder, f'{name}.meta.json')
+
+    def video_names(self):
+        return sorted(filename[:-len('.npy')] for filename in os.listdir(self.folder) if filename.endswith('.npy') and not filename.endswith('.tmp.npy'))
+
+    def save(self, name, keys, urls, frame_indices, vectors):
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        meta = {
+            'keys': [int(key) for key in keys],
+            'url': list(urls),
+            'frame_index': [int(frame_index) for frame_index in frame_indices]
+        }
+        if len(vectors) != len(meta['keys']):
+            raise ValueError(f'{name}: {len(vectors)} vectors for {len(meta["keys"])} frames')
+
+        # Vectors first, so a file with a sidecar is always complete
+        tmp_vectors = f'{self.vectors_file(name)}.tmp.npy'
+        np.save(tmp_vectors, vectors)
+        os.replace(tmp_vectors, self.vectors_file(name))
+        with open(f'{self.meta_file(name)}.tmp', 'w') as file:
+            json.dump(meta, file)
+        os.replace(f'{self.meta_file(name)}.tmp', self.meta_file(name))
+
+    def load_meta(self, name):
+        with open(self.meta_file(name), 'r') as file:
+            return json.load(file)
+
+    def load_vectors(self, name, mmap=True):
+        return np.load(self.vectors_file(name), mmap_mode='r' if mmap else None)
+
+    def load(self, name, mmap=True):
+        return self.load_meta(name), self.load_vectors(name, mmap=mmap)
+
+    def count(self, name):
+        # Only the .npy header is read
+        return self.load_vectors(name).shape[0]
+
+    def sort(self, name):
+        meta, vectors = self.load(name, mmap=False)
+        order = np.argsort(meta['keys'], kind='stable')
+        self.save(
+            name,
+            [meta['keys'][i] for i in order],
+            [meta['url'][i] for i in order],
+            [meta['frame_index'][i] for i in order],
+            vectors[order]
+        )
+
+    def convert_json(self, json_path, name=None):
+        name = name or os.path.splitext(os.path.basename(json_path))[0]
+        with open(json_path, 'r') as file:
+            listData = json.load(file)
+
+        keys = sorted(listData.keys(), key=int)
+        self.save(
+            name,
+            keys,
+            [listData[key]['url'] for key in keys],
+            [listData[key]['frame_index'] for key in keys],
+            np.array([listData[key]['vector_feature'] for key in keys], dtype=np.float32)
+        )
+        return name
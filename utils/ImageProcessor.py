@@ -1,16 +1,41 @@
-import os, json, torch, requests, concurrent.futures, time
+import os, json, torch, requests, queue, threading, time, numpy as np
 from PIL import Image
 from transformers import CLIPModel, CLIPProcessor
 from io import BytesIO
+from utils.FeatureStore import FeatureStore
+
+
+class StageStats:
+    # Items handled and time spent busy in one pipeline stage, shared by all of its workers
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, count, seconds):
+        with self.lock:
+            self.count += count
+            self.busy += seconds
+
+    def report(self, workers, elapsed):
+        # Per-worker rate while busy, and the stage's share of the wall-clock throughput
+        busy_rate = self.count / self.busy * workers if self.busy else 0.0
+        wall_rate = self.count / elapsed if elapsed else 0.0
+        return f'{self.name}: {self.count} images, {busy_rate:.1f} images/sec busy, {wall_rate:.1f} images/sec wall'
 
 
 class ImageProcessor:
-    def __init__(self, device, max_threads=6, max_retries=3, retry_delay=5):
+    def __init__(self, device, max_threads=6, max_retries=3, retry_delay=5, batch_size=32, queue_size=128, feature_store=None):
         self.device = device
+        # Binary per-video output; without one results are written as JSON like before
+        self.feature_store = feature_store
         self.max_threads = max_threads
         self.max_retries = max_retries
         self.retry_delay = retry_delay
-        self.clip_model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14")
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.clip_model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14").to(device).eval()
         self.clip_preprocess = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
 
 
@@ -74,13 +99,16 @@ class ImageProcessor:
         return None
 
     def extract_clip_features(self, image):
-        inputs = self.clip_preprocess(images=image, return_tensors="pt").to(device)
+        return self.extract_clip_features_batch([image])[0]
+
+    def extract_clip_features_batch(self, images):
+        inputs = self.clip_preprocess(images=images, return_tensors="pt").to(self.device)
 
         # Extract image features only
         with torch.no_grad():
             image_features = self.clip_model.get_image_features(**inputs)
 
-        return image_features.cpu().numpy().flatten()
+        return image_features.cpu().numpy()
 
     # def upload_to_dropbox(self, image, image_name, folder='aic', fallback_folder='aic_backup', retry_count=3):
     #     buffer = BytesIO()
@@ -141,34 +169,107 @@ class ImageProcessor:
     #                     print(f"Error during upload to fallback folder: {fallback_e}")
     #                     raise
 
+    # Three stages joined by bounded queues: I/O threads fetch and decode, one batcher runs
+    # CLIP on fixed-size batches, one writer collects the vectors and saves the file
     def process_images_in_jsonfile(self, filename, filepath):
-        
-        child_folder_data = {}
-
-        def process_image(url, index, frame_index):
-            image = self.open_image(url)
-            vector_feature = self.extract_clip_features(image)
-            
-            print(f'Extracted image features from {filename}_{index} successfully!')
-
-            if url:
-                child_folder_data[int(index)] = {
-                    "url": url,
-                    "vector_feature": vector_feature.tolist(),
-                    "frame_index": int(frame_index),
-                }
-
         data = self.read_json(filepath)
+        if data is None:
+            return
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures = [executor.submit(process_image, entry['url'], key, entry['frame_index']) for key, entry in data.items()]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error processing image: {e}")
+        tasks = queue.Queue()
+        for key, entry in data.items():
+            tasks.put((key, entry['url'], entry['frame_index']))
 
-        self.save_json(filepath=f'D:/AIC/model/assets/results/{filename}_details.json', data=child_folder_data)
+        images = queue.Queue(maxsize=self.queue_size)
+        batches = queue.Queue(maxsize=max(1, self.queue_size // self.batch_size))
+        stats = {name: StageStats(name) for name in ('fetch', 'encode', 'write')}
+        child_folder_data = {}
+        done = object()
+
+        def fetch():
+            # The sentinel always goes out, or encode would wait for it forever
+            try:
+                while True:
+                    try:
+                        key, url, frame_index = tasks.get_nowait()
+                    except queue.Empty:
+                        return
+
+                    start = time.perf_counter()
+                    try:
+                        image = self.open_image(url) if url else None
+                    except Exception as e:
+                        print(f"Error fetching image {url} for frame {key} of {filename}: {e}")
+                        image = None
+                    stats['fetch'].add(1, time.perf_counter() - start)
+
+                    if image is not None:
+                        images.put((key, url, frame_index, image))
+            finally:
+                images.put(done)
+
+        def encode():
+            batch, finished = [], 0
+            while finished < self.max_threads:
+                item = images.get()
+                if item is done:
+                    finished += 1
+                else:
+                    batch.append(item)
+
+                if batch and (len(batch) == self.batch_size or finished == self.max_threads):
+                    start = time.perf_counter()
+                    try:
+                        vectors = self.extract_clip_features_batch([image for _, _, _, image in batch])
+                        batches.put((batch, vectors))
+                    except Exception as e:
+                        print(f"Error extracting features for a batch of {len(batch)} images from {filename}: {e}")
+                    stats['encode'].add(len(batch), time.perf_counter() - start)
+                    batch = []
+            batches.put(done)
+
+        def write():
+            while True:
+                item = batches.get()
+                if item is done:
+                    return
+
+                start = time.perf_counter()
+                batch, vectors = item
+                for (key, url, frame_index, _), vector_feature in zip(batch, vectors):
+                    child_folder_data[int(key)] = {
+                        "url": url,
+                        "vector_feature": vector_feature if self.feature_store else vector_feature.tolist(),
+                        "frame_index": int(frame_index),
+                    }
+                stats['write'].add(len(batch), time.perf_counter() - start)
+                print(f'Extracted image features for {len(child_folder_data)}/{len(data)} frames of {filename}')
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=fetch, daemon=True) for _ in range(self.max_threads)]
+        workers += [threading.Thread(target=encode, daemon=True), threading.Thread(target=write, daemon=True)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        if self.feature_store:
+            keys = sorted(child_folder_data)
+            self.feature_store.save(
+                os.path.splitext(filename)[0],
+                keys,
+                [child_folder_data[key]['url'] for key in keys],
+                [child_folder_data[key]['frame_index'] for key in keys],
+                np.array([child_folder_data[key]['vector_feature'] for key in keys], dtype=np.float32)
+            )
+        else:
+            self.save_json(filepath=f'D:/AIC/model/assets/results/{filename}_details.json', data=child_folder_data)
+
+        print(f'Processed {filename} in {elapsed:.1f}s')
+        print(stats['fetch'].report(self.max_threads, elapsed))
+        print(stats['encode'].report(1, elapsed))
+        print(stats['write'].report(1, elapsed))
 
     def process_images_in_folder(self, root_folder):
         
@@ -185,11 +286,12 @@ class ImageProcessor:
 # Constants for paths and configuration
 DROPBOX_JSON = 'D:/AIC/model/assets/credentials.json'
 ROOT_FOLDER = 'D:/AIC/model/assets/storage'
+FEATURE_PATH = 'D:/AIC/model/assets/features'
 
 if __name__ == '__main__':
     with open(DROPBOX_JSON) as file:
         dropbox_conf = json.load(file)
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    imageProcessor = ImageProcessor(device=device)
+    imageProcessor = ImageProcessor(device=device, max_threads=int(os.getenv('FETCH_WORKERS', 6)), batch_size=int(os.getenv('BATCH_SIZE', 32)), feature_store=FeatureStore(FEATURE_PATH, dtype=os.getenv('FEATURE_DTYPE', 'float32')))
     imageProcessor.process_images_in_folder(ROOT_FOLDER)
\ No newline at end of file
@@ -1,76 +1,310 @@
-import faiss, mysql.connector, torch, numpy as np, pandas as pd
-from langdetect import detect
-from io import BytesIO
-from transformers import CLIPModel, CLIPProcessor, CLIPTokenizer
+import os, copy, json, base64, binascii, logging, threading, time, faiss, numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from langdetect import detect, LangDetectException
+from utils.IndexBuilder import set_search_params, filtered_search_params, bitmap_selector
+from utils.MetadataStore import MetadataStore
+from utils.DatabasePool import DatabasePool
+from utils.VectorStore import VectorStore
+from utils.LRUCache import LRUCache
+from utils.TextEncoder import ClipTextEncoder, MultilingualTextEncoder
+from utils.BatchScheduler import BatchScheduler
+from utils.Metrics import Metrics, traced
+from utils.TemporalSearch import join_sequences
+from utils.FeatureStore import parse_video_name
+from utils.ShardedIndex import ShardedIndex
 
+logger = logging.getLogger(__name__)
 
 
 class ImageTextSearchEngine:
+    # Heavy components, in warmup order; each loads on first use
+    COMPONENTS = ('index', 'metadata', 'vectors', 'clip_text_encoder', 'multilingual_encoder')
+    # Near-duplicate clusters (insert.py --dedup-threshold) come back as their representative, or as all members
+    CLUSTER_MODES = ('collapse', 'expand')
+    # Rows exported from a result token when the request sets no limit
+    EXPORT_DEPTH = 100
+
     # Initial search engine
-    def __init__(self, db_config, bin_file, translator, text_preprocessing, clip_backbone='ViT-B/32', device='cpu'):
-        self.db_connection = mysql.connector.connect(**db_config)
-        self.db_cursor = self.db_connection.cursor()
+    def __init__(self, db_config, bin_file, translator, text_preprocessing, clip_backbone='ViT-B/32', device='cpu', nprobe=None, ef_search=None, metadata_path=None, vectors_path=None, db_pool_size=5, cache_size=10000, cache_ttl=None, cache_dir=None, result_cache_bytes=256 * 1024 * 1024, result_ttl=600, prefetch_k=None, multilingual_model=None, text_encoder='clip', index_mmap=False, clip_model='openai/clip-vit-large-patch14', clip_backend='torch', clip_threads=None, clip_onnx_path=None, batch_max_size=None, batch_max_wait_ms=5, stage_workers=None, metrics=None, shards_path=None, shard_workers=None, rerank_factor=None, manifest_path=None):
+        start = time.perf_counter()
+        self.metrics = metrics or Metrics()
+        # Connections are opened on first checkout
+        self.db_pool = DatabasePool(db_config, pool_size=db_pool_size)
         self.device = device
-        self.clip_model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14")
-        self.clip_preprocess = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
-        self.clip_tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
+        self.clip_model_name = clip_model
+        # 'int8' or 'onnx' trade a little embedding parity for CPU latency, see benchmark_text.py clip-backends
+        self.clip_options = {'backend': clip_backend, 'num_threads': clip_threads, 'onnx_path': clip_onnx_path}
         self.translator = translator
         self.text_preprocessing = text_preprocessing
-        self.index = self.load_faiss_index(bin_file)
+        # 'clip' translates and preprocesses before CLIP, 'multilingual' embeds the raw query directly
+        self.text_encoder = text_encoder
+        self.multilingual_model = multilingual_model
+        self.bin_file = bin_file
+        self.index_mtime = None
+        # Memory-mapped index pages come from the page cache, so forked workers share one copy
+        self.index_mmap = index_mmap
+        # Layout file of a sharded build from insert.py --shards; used instead of bin_file when it exists
+        self.shards_path = shards_path
+        self.shard_workers = shard_workers
+        self.metadata_path = metadata_path
+        self.vectors_path = vectors_path
+        # Manifest of insert.py, naming the store directories in use once it has compacted them into new ones
+        self.manifest_path = manifest_path
+        self.manifest_mtime = None
+        # With a compressed index (sq8/fp16/ivf_sq8/ivf_pq), searches fetch k * rerank_factor candidates and re-rank them
+        # by exact inner product against the memory-mapped vector store
+        self.rerank_factor = rerank_factor
+        self.index_positions = None
+
+        self.components = {}
+        self.component_locks = {name: threading.Lock() for name in self.COMPONENTS}
+        self.loaders = {
+            'index': lambda: self.load_faiss_index(self.bin_file),
+            'metadata': self.load_metadata,
+            'vectors': self.load_vectors,
+            'clip_text_encoder': lambda: ClipTextEncoder(self.clip_model_name, device=self.device, **self.clip_options),
+            'multilingual_encoder': lambda: MultilingualTextEncoder(self.multilingual_model, device=self.device) if self.multilingual_model else None
+        }
+        self.search_params = {}
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.translation_cache = LRUCache(max_size=cache_size, ttl=cache_ttl, persist_path=cache_dir and os.path.join(cache_dir, 'translations.pkl'))
+        self.embedding_cache = LRUCache(max_size=cache_size, ttl=cache_ttl, persist_path=cache_dir and os.path.join(cache_dir, 'embeddings.pkl'))
+        # Ranked ids of recent searches under a result token, so later pages skip encoding and the faiss scan
+        self.result_cache = LRUCache(max_size=cache_size, ttl=result_ttl, max_bytes=result_cache_bytes, sizeof=lambda entry: entry['ids'].nbytes + entry['vector'].nbytes)
+        self.prefetch_k = prefetch_k
+        # faiss id selectors per folder/video filter; rebuilt after a reload since ids change
+        self.selector_cache = LRUCache(max_size=256)
+        # Concurrent text queries are micro-batched into one encoder pass and one faiss search
+        self.text_scheduler = BatchScheduler(self.search_text_batch, max_batch_size=batch_max_size, max_wait_ms=batch_max_wait_ms, name='text-search') if batch_max_size and batch_max_size > 1 else None
+        # Optional pools per blocking stage ('encode', 'search', 'hydrate'), so a burst of requests
+        # cannot run more concurrent model passes or MySQL queries than the pool allows
+        self.stage_executors = {stage: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=stage) for stage, workers in (stage_workers or {}).items() if workers}
+        self.load_timings = {'init': time.perf_counter() - start}
+
+    # Timed, and run on the stage's pool if it has one; the time includes waiting for a pool thread
+    def run_stage(self, stage, function, *args, **kwargs):
+        with self.metrics.stage(stage):
+            executor = self.stage_executors.get(stage)
+            if executor is None:
+                return function(*args, **kwargs)
+            return executor.submit(self.metrics.run_in, self.metrics.current(), function, *args, **kwargs).result()
+
+    def component(self, name):
+        if name not in self.components:
+            with self.component_locks[name]:
+                if name not in self.components:
+                    start = time.perf_counter()
+                    self.components[name] = self.loaders[name]()
+                    self.load_timings[name] = time.perf_counter() - start
+                    logger.info(f'Loaded {name} in {self.load_timings[name]:.2f}s')
+        return self.components[name]
+
+    @property
+    def index(self):
+        return self.component('index')
+
+    @index.setter
+    def index(self, index):
+        self.components['index'] = index
+
+    @property
+    def metadata(self):
+        return self.component('metadata')
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self.components['metadata'] = metadata
+
+    @property
+    def vectors(self):
+        return self.component('vectors')
+
+    @vectors.setter
+    def vectors(self, vectors):
+        self.components['vectors'] = vectors
+
+    @property
+    def clip_text_encoder(self):
+        return self.component('clip_text_encoder')
+
+    @property
+    def multilingual_encoder(self):
+        return self.component('multilingual_encoder')
+
+    def configured_components(self):
+        return [name for name in self.COMPONENTS if name != 'multilingual_encoder' or self.multilingual_model]
+
+    # Load everything up front, by default on a background thread so the server accepts connections meanwhile
+    def warmup(self, background=True):
+        def load_all():
+            for name in self.configured_components():
+                try:
+                    self.component(name)
+                except Exception as e:
+                    logger.error(f'Error loading {name}: {e}')
+            # The translation model is the translator's own lazy component
+            if hasattr(self.translator, 'warmup'):
+                start = time.perf_counter()
+                try:
+                    self.translator.warmup()
+                    self.load_timings['translator'] = time.perf_counter() - start
+                except Exception as e:
+                    logger.error(f'Error loading translator: {e}')
+
+        if background:
+            threading.Thread(target=load_all, daemon=True).start()
+        else:
+            load_all()
+
+    def readiness(self):
+        loaded = {name: name in self.components for name in self.configured_components()}
+        if hasattr(self.translator, 'ready'):
+            loaded['translator'] = self.translator.ready
+        return {'ready': all(loaded.values()), 'components': loaded, 'timings': dict(self.load_timings)}
+
+    def index_file(self):
+        if self.shards_path and os.path.exists(self.shards_path):
+            return self.shards_path
+        return self.bin_file
 
     def load_faiss_index(self, bin_file):
-        if bin_file:
-            return faiss.read_index(bin_file)
+        if not self.index_file():
+            return None
+        # IO_FLAG_MMAP_IFC also maps flat codes, on faiss builds that have it
+        io_flags = faiss.IO_FLAG_MMAP | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0) if self.index_mmap else 0
+        self.index_mtime = os.path.getmtime(self.index_file())
+        if self.index_file() == self.shards_path:
+            index = ShardedIndex.load(self.shards_path, io_flags=io_flags, workers=self.shard_workers)
+        else:
+            index = faiss.read_index(bin_file, io_flags)
+        set_search_params(index, **self.search_params)
+        return index
+
+    def load_vectors(self):
+        vectors_path = self.store_path(self.vectors_path, 'vectors')
+        if vectors_path and os.path.isdir(vectors_path):
+            # Vectors have the dimension of the index they were added to
+            return VectorStore.load(vectors_path, dim=self.index.d)
         return None
 
+    # The configured store directory, or the version next to it the manifest switched to
+    def store_path(self, path, name):
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return path
+        self.manifest_mtime = os.path.getmtime(self.manifest_path)
+        if not path:
+            return path
+        with open(self.manifest_path, 'r') as file:
+            manifest = json.load(file)
+        # Older manifests are the bare videos dict and have no stores
+        stores = manifest.get('stores') if 'videos' in manifest else None
+        return os.path.join(os.path.dirname(path), stores[name]) if stores else path
+
+    # Runtime recall/speed trade-off for IVF (nprobe) and HNSW (efSearch) indexes
+    def set_search_params(self, nprobe=None, ef_search=None):
+        # Remembered so a reloaded index gets the same settings
+        if nprobe is not None:
+            self.search_params['nprobe'] = nprobe
+        if ef_search is not None:
+            self.search_params['ef_search'] = ef_search
+        # A lazily loaded index picks the settings up when it is read
+        if self.components.get('index') is not None:
+            set_search_params(self.index, **self.search_params)
+
+    # Swap in the index insert.py wrote; searches already running finish on the old object
+    def reload_index(self):
+        current = self.components.get('index')
+        if isinstance(current, ShardedIndex) and self.index_file() == self.shards_path and current.same_layout():
+            # Only the rewritten shards are read and swapped, one at a time
+            self.index_mtime = os.path.getmtime(self.shards_path)
+            reloaded = current.reload_changed(prepare=lambda shard: set_search_params(shard, **self.search_params))
+            logger.info(f'Reloaded shards {reloaded}')
+            return current.ntotal
+
+        index = self.load_faiss_index(self.bin_file)
+        self.index = index
+        return index.ntotal
+
+    def reload(self):
+        ntotal = self.reload_index()
+        return {'ntotal': ntotal, **self.reload_stores()}
+
+    def reload_stores(self):
+        rows = self.reload_metadata()
+        self.vectors = self.load_vectors()
+        # Cached rankings and selectors may point at ids that were just removed
+        self.result_cache.clear()
+        self.selector_cache.clear()
+        return {'rows': rows}
+
+    def reload_if_changed(self):
+        # Nothing to swap before the first load
+        if not self.index_file() or 'index' not in self.components:
+            return None
+        if os.path.getmtime(self.index_file()) != self.index_mtime:
+            return self.reload()
+        # insert.py writes the manifest after the index, switching to compacted stores
+        if self.manifest_path and os.path.exists(self.manifest_path) and os.path.getmtime(self.manifest_path) != self.manifest_mtime:
+            return self.reload_stores()
+        return None
+
+    # Poll the index file so incremental runs of insert.py are picked up without a restart
+    def watch_index(self, interval=30):
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.reload_if_changed():
+                        logger.info(f'Reloaded index {self.index_file()}')
+                except Exception as e:
+                    logger.error(f'Error reloading index {self.index_file()}: {e}')
+
+        threading.Thread(target=watch, daemon=True).start()
+
+    # Columnar id -> metadata table, from the files written by insert.py or else from MySQL
+    def load_metadata(self):
+        metadata_path = self.store_path(self.metadata_path, 'metadata')
+        if metadata_path and os.path.isdir(metadata_path):
+            return MetadataStore.load(metadata_path)
+        with self.db_pool.cursor(buffered=False) as cursor:
+            return MetadataStore.from_db(cursor)
+
+    # Build the new table on the side and swap the reference, so in-flight searches keep a consistent view
+    def reload_metadata(self):
+        metadata_path = self.store_path(self.metadata_path, 'metadata')
+        if metadata_path and os.path.isdir(metadata_path):
+            metadata = MetadataStore.load(metadata_path)
+        else:
+            with self.db_pool.cursor(buffered=False) as cursor:
+                metadata = copy.copy(self.metadata).load_rows_from_db(cursor)
+            # Only newer rows are read, so rows insert.py --incremental deleted would linger; a count
+            # mismatch means some were deleted and the table is read again in full
+            if self.db_pool.fetchone("SELECT COUNT(*) FROM image_features")[0] != len(metadata):
+                with self.db_pool.cursor(buffered=False) as cursor:
+                    metadata = MetadataStore.from_db(cursor)
+        self.metadata = metadata
+        return len(metadata)
+
     def normalize(self, vectors):
         norms = np.linalg.norm(vectors, axis=1, keepdims=True)
         return vectors / norms
 
 
-    def get_image_feature_by_tuple(self, id_tuple: tuple):
-        placeholders = ','.join(['%s'] * len(id_tuple))
-        order_by_case = " ".join([f"WHEN %s THEN {i}" for i in range(len(id_tuple))])
-        sql = f"""
-            SELECT img_feat.id, img_feat.folder_id, img_feat.child_folder_id, img_feat.id_frame, img_feat.image_path, img_feat.frame_mapping_index
-            FROM image_features AS img_feat
-            INNER JOIN (
-                SELECT folder_id, child_folder_id, id_frame
-                FROM image_features
-            ) AS tmp
-            ON tmp.folder_id = img_feat.folder_id
-            AND tmp.child_folder_id = img_feat.child_folder_id
-            AND tmp.id_frame = img_feat.id_frame
-            AND img_feat.id IN ({placeholders})
-            ORDER BY CASE img_feat.id {order_by_case} END;
-        """
-        parameters = id_tuple + id_tuple
-        self.db_cursor.execute(sql, parameters)
-        rows = self.db_cursor.fetchall()
-
-        results = [{
-            'id': row[0],
-            'folder_id': row[1],
-            'child_folder_id': row[2],
-            'id_frame': row[3],
-            'image_path': row[4],
-            'frame_mapping_index': row[5]
-        } for row in rows]
-
-        return results
-    
+    def get_image_feature_by_tuple(self, id_tuple: tuple, clusters=None):
+        if clusters not in (None,) + self.CLUSTER_MODES:
+            raise ValueError(f'Unknown clusters mode {clusters}, expected one of {self.CLUSTER_MODES}')
+        if clusters == 'expand':
+            return self.run_stage('hydrate', lambda: self.metadata.gather(self.metadata.cluster_members(id_tuple)))
+        return self.run_stage('hydrate', self.metadata.gather, id_tuple)
+
     # Search images by image
-    def search_images_by_id(self, image_id, k):
-        sql = "SELECT vector_features FROM image_features WHERE id = %s"
-        self.db_cursor.execute(sql, (image_id,))
-        row = self.db_cursor.fetchone()
-        
-        vector_blob = row[0]
-        query_vector = np.frombuffer(vector_blob, dtype='float32')
-        query_vector = query_vector.reshape(1, -1)
-        query_vector = self.normalize(query_vector)
+    @traced('image_search')
+    def search_images_by_id(self, image_id, k, filters=None, clusters=None):
+        query_vector = self.get_vectors_by_ids([int(image_id)])
 
-        _, indices = self.index.search(query_vector, k)
+        _, indices = self.search_index(query_vector, k, filters=filters)
 
         indices = indices.flatten()
 
@@ -79,60 +313,437 @@ class ImageTextSearchEngine:
         
         id_tuple = tuple(int(i) for i in indices)
 
-        return self.get_image_feature_by_tuple(id_tuple)
+        return self.get_image_feature_by_tuple(id_tuple, clusters=clusters)
 
-    # Search images by text
-    def search_images_by_text(self, text:str, k):
-        detect_lang = detect(text)
+    def translate_text(self, text:str):
+        return self.translate_texts([text])[0]
+
+    # langdetect raises on text without letters (e.g. '2024'); such a query is left untranslated
+    def is_vietnamese(self, text):
+        try:
+            return detect(text) == 'vi'
+        except LangDetectException:
+            return False
+
+    # Language detection for every cache miss, then one translator call for all the Vietnamese ones
+    def translate_texts(self, texts):
+        translated = {text: self.translation_cache.get(text) for text in dict.fromkeys(texts)}
+        missing = [text for text, translated_text in translated.items() if translated_text is None]
+
+        if missing:
+            with self.metrics.stage('detect'):
+                vietnamese = [text for text in missing if self.is_vietnamese(text)]
+            for text in set(missing) - set(vietnamese):
+                translated[text] = text
+                self.translation_cache.put(text, text)
+
+            if vietnamese:
+                with self.metrics.stage('translate'):
+                    if hasattr(self.translator, 'translate_batch'):
+                        translations = self.translator.translate_batch(vietnamese)
+                    else:
+                        translations = [self.translator(text) for text in vietnamese]
+                for text, translated_text in zip(vietnamese, translations):
+                    translated[text] = translated_text
+                    # An unchanged Vietnamese query means the translator gave up (e.g. over its latency budget), so retry next time
+                    if translated_text.lower() != text.lower():
+                        self.translation_cache.put(text, translated_text)
+
+        return [translated[text] for text in texts]
+
+    def resolve_encoder(self, encoder=None):
+        encoder = encoder or self.text_encoder
+        if encoder == 'multilingual' and not self.multilingual_model:
+            raise ValueError('Multilingual encoder requested but no multilingual_model is configured')
+        if encoder not in ('clip', 'multilingual'):
+            raise ValueError(f'Unknown text encoder {encoder}')
+        return encoder
+
+    # Encode a list of queries in one forward pass, skipping queries whose embedding is cached
+    def encode_texts(self, texts, encoder=None):
+        encoder = self.resolve_encoder(encoder)
+
+        fingerprint = self.encoder_fingerprint(encoder)
+        keys = [(fingerprint, text) for text in texts]
+        text_embeddings = [self.embedding_cache.get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, embedding in zip(keys, text_embeddings) if embedding is None))
+
+        if missing:
+            if encoder == 'multilingual':
+                with self.metrics.stage('text_model'):
+                    new_embeddings = self.multilingual_encoder.encode([text for _, text in missing])
+            else:
+                new_embeddings = self.encode_with_clip([text for _, text in missing])
+
+            new_embeddings = dict(zip(missing, new_embeddings))
+            for key, embedding in new_embeddings.items():
+                self.embedding_cache.put(key, embedding)
+
+            text_embeddings = [new_embeddings[key] if embedding is None else embedding for key, embedding in zip(keys, text_embeddings)]
+
+        return np.vstack(text_embeddings)
+
+    # Everything a query's embedding depends on besides its text. Cached embeddings are keyed by it, so a
+    # persisted cache is not reused after the model, backend, preprocessing or translation changes.
+    def encoder_fingerprint(self, encoder):
+        if encoder == 'multilingual':
+            return (encoder, self.multilingual_model)
+        return (
+            encoder,
+            self.clip_model_name,
+            self.clip_options['backend'],
+            self.clip_options['onnx_path'],
+            tuple(sorted(getattr(self.text_preprocessing, 'stages', ()))),
+            getattr(self.translator, 'fingerprint', type(self.translator).__name__)
+        )
+
+    def encode_with_clip(self, texts):
+        translated_texts = self.translate_texts(texts)
+        with self.metrics.stage('preprocess'):
+            processed_texts = self.text_preprocessing.process_batch(translated_texts)
+        with self.metrics.stage('text_model'):
+            return self.clip_text_encoder.encode(processed_texts)
+
+    # Filters restrict a search to folders / videos. Accepts lists or strings: folders and child_folders as
+    # '1,3,5-8', videos as 'L01_V003,L02_V001'. Returns a hashable (folders, child_folders, videos) or None.
+    def normalize_filters(self, filters):
+        if not filters:
+            return None
+
+        def numbers(value):
+            if value is None or value == '':
+                return None
+            if isinstance(value, str):
+                value = value.split(',')
+            result = set()
+            for item in value:
+                if isinstance(item, str) and '-' in item:
+                    first, last = item.split('-')
+                    result.update(range(int(first), int(last) + 1))
+                else:
+                    result.add(int(item))
+            return tuple(sorted(result))
+
+        videos = filters.get('videos') or ()
+        if isinstance(videos, str):
+            videos = videos.split(',')
+        videos = tuple(sorted(parse_video_name(video) if isinstance(video, str) else tuple(video) for video in videos))
 
-        if detect_lang == 'vi':
-            translated_text = self.translator(text)
+        normalized = (numbers(filters.get('folders')), numbers(filters.get('child_folders')), videos)
+        return normalized if normalized != (None, None, ()) else None
+
+    # The selector is built from the per-video layout of the metadata, then reused for the same filter
+    def filter_selector(self, filters):
+        entry = self.selector_cache.get(filters)
+        if entry is None:
+            folders, child_folders, videos = filters
+            ids = self.metadata.ids_in_videos(folders=folders, child_folders=child_folders, videos=videos)
+            entry = (bitmap_selector(ids) if len(ids) else None, len(ids))
+            self.selector_cache.put(filters, entry)
+        return entry
+
+    # faiss search restricted by an id selector, so filtered queries still get a full k from the selected videos
+    def search_index(self, query_vectors, k, filters=None):
+        filters = self.normalize_filters(filters) if isinstance(filters, dict) else filters
+        vectors = self.vectors if self.rerank_factor else None
+        fetch_k = k * self.rerank_factor if vectors is not None else k
+
+        if not filters:
+            distances, indices = self.run_stage('search', self.index.search, query_vectors, fetch_k)
         else:
-            translated_text = text
-        
-        processed_text = self.text_preprocessing(translated_text)
+            selector, count = self.filter_selector(filters)
+            if count == 0:
+                return np.full((len(query_vectors), k), -np.inf, dtype=np.float32), np.full((len(query_vectors), k), -1, dtype=np.int64)
+            distances, indices = self.run_stage('search', self.index.search, query_vectors, fetch_k, params=filtered_search_params(self.index, selector))
 
-        text_tokenized = self.clip_tokenizer(processed_text, return_tensors='pt').to(self.device)
+        if vectors is None:
+            return distances, indices
+        return self.run_stage('rerank', vectors.rerank, query_vectors, distances, indices, k)
 
-        with torch.no_grad():
-            text_embedding = self.clip_model.get_text_features(**text_tokenized).cpu().numpy()
-            text_embedding = self.normalize(text_embedding)
-            _, indices = self.index.search(text_embedding, k)
+    # Query vector and ranked ids for one text query, through the scheduler when batching is on
+    def search_text(self, text, k, encoder=None, filters=None):
+        encoder = self.resolve_encoder(encoder)
+        # A filtered search cannot share the batch's single faiss call
+        if self.text_scheduler is not None and not filters:
+            # Queue wait plus the shared encode and search; the batch itself records those stages
+            with self.metrics.stage('batched_encode_search'):
+                return self.text_scheduler((text, encoder, k))
 
-            indices = indices.flatten()
-            print(indices)
-            if len(indices) == 0:
-                return []
+        query_vector = self.run_stage('encode', self.encode_texts, [text], encoder=encoder)
+        _, indices = self.search_index(query_vector, k, filters=filters)
+        return query_vector, indices[0]
 
-            id_tuple = tuple(int(i) for i in indices)
+    # Scheduler handler: one encoder pass per encoder and one faiss search at the largest k, sliced per caller
+    def search_text_batch(self, requests):
+        query_vectors = [None] * len(requests)
+        for encoder in set(encoder for _, encoder, _ in requests):
+            positions = [i for i, request in enumerate(requests) if request[1] == encoder]
+            embeddings = self.run_stage('encode', self.encode_texts, [requests[i][0] for i in positions], encoder=encoder)
+            for i, embedding in zip(positions, embeddings):
+                query_vectors[i] = embedding
 
-            return self.get_image_feature_by_tuple(id_tuple)
+        query_vectors = np.vstack(query_vectors)
+        _, indices = self.search_index(query_vectors, max(k for _, _, k in requests))
+        return [(query_vectors[i:i + 1], indices[i, :k]) for i, (_, _, k) in enumerate(requests)]
 
-    def download_csv(self, data):
-        def handle_folder_id(id):
-            if id < 10:
-                return f'0{id}'
-            return f'{id}'
-        
-        def handle_subfolder_id(id):
-            if id < 10:
-                return f'00{id}'
-            return f'0{id}'
-        
-        df = pd.DataFrame({
-            'Folder': [f'L{handle_folder_id(row["folder_id"])}_V{handle_subfolder_id(row["child_folder_id"])}' for row in data],
-            'Frame index': [row['frame_mapping_index'] for row in data]
-        })
+    def cache_stats(self):
+        return {
+            'translation': self.translation_cache.stats(),
+            'embedding': self.embedding_cache.stats(),
+            'result': self.result_cache.stats()
+        }
+
+    # A result token is the query itself, encoded, so whichever worker receives it can rank it again;
+    # result_cache only spares the worker that already ranked it the encoding and the faiss scan
+    def encode_cursor(self, text=None, image_id=None, encoder=None, filters=None):
+        query = {'text': text, 'image_id': None if image_id is None else int(image_id), 'encoder': encoder or self.text_encoder, 'filters': filters or None}
+        payload = json.dumps(query, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            query = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        except (ValueError, binascii.Error) as e:
+            raise ValueError(f'Invalid result token {cursor}') from e
+        if not isinstance(query, dict) or (query.get('text') is None) == (query.get('image_id') is None):
+            raise ValueError(f'Invalid result token {cursor}')
+        return query
+
+    # Ranked ids of the query behind a result token, from result_cache or ranked here to at least depth
+    def ranking(self, cursor, depth):
+        entry = self.result_cache.get(cursor)
+        if entry is None:
+            query = self.decode_cursor(cursor)
+            filters = self.normalize_filters(query['filters'])
+            fetch_k = max(depth, self.prefetch_k or 0)
+            if query['text'] is not None:
+                query_vector, indices = self.search_text(query['text'], fetch_k, encoder=query['encoder'], filters=filters)
+            else:
+                query_vector = self.get_vectors_by_ids([query['image_id']])
+                _, indices = self.search_index(query_vector, fetch_k, filters=filters)
+                indices = indices[0]
+            ids = indices[indices >= 0]
+            entry = {'vector': query_vector, 'filters': filters, 'ids': ids, 'exhausted': len(ids) < fetch_k}
+
+        entry = self.extend_ranking(entry, depth)
+        self.result_cache.put(cursor, entry)
+        return entry
+
+    # Paginated search: the first call ranks max(offset + k, prefetch_k) hits, later pages only hydrate their slice.
+    # Offsets and k count clusters; an expanded page holds every member of its k clusters.
+    # Without text or image_id the query comes from cursor.
+    @traced(lambda self, arguments: self.page_operation(**arguments))
+    def search_page(self, text=None, image_id=None, k=10, offset=0, cursor=None, encoder=None, filters=None, clusters=None):
+        if text is not None or image_id is not None:
+            cursor = self.encode_cursor(text=text, image_id=image_id, encoder=encoder, filters=filters)
+        elif cursor is None:
+            raise ValueError('search_page needs text, image_id or a result token')
+
+        entry = self.ranking(cursor, offset + k)
+
+        page = entry['ids'][offset:offset + k]
+        next_offset = offset + len(page)
+        has_more = next_offset < len(entry['ids']) or not entry['exhausted']
+
+        return {
+            'results': self.get_image_feature_by_tuple(tuple(int(i) for i in page), clusters=clusters),
+            'cursor': cursor,
+            'next_offset': next_offset if has_more else None
+        }
+
+    # Text and image pages are timed apart, their latencies have little in common. A page from a bare cursor
+    # is timed by the query the cursor encodes.
+    def page_operation(self, text=None, image_id=None, cursor=None, **_):
+        if text is None and image_id is None and cursor is not None:
+            try:
+                query = self.decode_cursor(cursor)
+            except ValueError:
+                return 'search_page'
+            text, image_id = query['text'], query['image_id']
+        if text is not None:
+            return 'search_page_text'
+        return 'search_page_image' if image_id is not None else 'search_page'
+
+    # Rank deeper only when the requested depth runs past what is cached
+    def extend_ranking(self, entry, depth):
+        if depth <= len(entry['ids']) or entry['exhausted']:
+            return entry
+        fetch_k = max(depth, self.prefetch_k or 0, 2 * len(entry['ids']))
+        _, indices = self.search_index(entry['vector'], fetch_k, filters=entry.get('filters'))
+        ids = indices[0][indices[0] >= 0]
+        return dict(entry, ids=ids, exhausted=len(ids) < fetch_k)
+
+    # Search images by text
+    @traced('text_search')
+    def search_images_by_text(self, text:str, k, encoder=None, filters=None, clusters=None):
+        _, indices = self.search_text(text, k, encoder=encoder, filters=filters)
+        logger.debug(f'Text search {text!r} -> {indices}')
+        if len(indices) == 0:
+            return []
+
+        id_tuple = tuple(int(i) for i in indices)
+
+        return self.get_image_feature_by_tuple(id_tuple, clusters=clusters)
+
+    # Query-by-example vectors come from the vector store, then the index itself, and only then from MySQL
+    def get_vectors_by_ids(self, ids):
+        with self.metrics.stage('vector_lookup'):
+            return self.lookup_vectors(ids)
+
+    def lookup_vectors(self, ids):
+        if self.vectors is not None:
+            try:
+                return self.vectors.get(ids)
+            except KeyError:
+                pass
+
+        try:
+            return self.reconstruct_from_index(ids)
+        except (KeyError, RuntimeError):
+            return self.fetch_vectors_from_db(ids)
+
+    def reconstruct_from_index(self, ids):
+        current = self.index
+        # Shards have no id lookup across them; the vector store or MySQL covers sharded builds
+        if isinstance(current, ShardedIndex):
+            raise KeyError(f'Image ids not reconstructable from a sharded index: {list(ids)}')
+        index = faiss.downcast_index(current)
+
+        # IndexIDMap has no reverse map, so look ids up in a sorted copy of its id_map
+        if type(index) is faiss.IndexIDMap:
+            if self.index_positions is None or self.index_positions[0] is not current:
+                id_map = faiss.vector_to_array(index.id_map)
+                order = np.argsort(id_map)
+                self.index_positions = (current, id_map[order], order)
+
+            _, sorted_ids, order = self.index_positions
+            ids = np.asarray(ids, dtype=np.int64)
+            if len(sorted_ids) == 0:
+                raise KeyError(f'Image ids not found in index: {ids.tolist()}')
+            slots = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+            if np.any(sorted_ids[slots] != ids):
+                raise KeyError(f'Image ids not found in index: {ids.tolist()}')
+            return np.stack([index.index.reconstruct(int(order[slot])) for slot in slots])
+
+        # IndexIDMap2 and IVF indexes with a direct map reconstruct by id
+        return np.stack([index.reconstruct(int(image_id)) for image_id in ids])
+
+    def fetch_vectors_from_db(self, ids):
+        placeholders = ','.join(['%s'] * len(ids))
+        sql = f"SELECT id, vector_features FROM image_features WHERE id IN ({placeholders})"
+        blobs = {row[0]: row[1] for row in self.db_pool.fetchall(sql, tuple(ids))}
+
+        missing = [image_id for image_id in ids if image_id not in blobs]
+        if missing:
+            raise KeyError(f'Image ids not found: {missing}')
+
+        vectors = np.stack([np.frombuffer(blobs[image_id], dtype='float32') for image_id in ids])
+        return self.normalize(vectors)
+
+    # Search a batch of text and image queries with one encoder pass and one faiss search
+    @traced('search_many')
+    def search_many(self, texts=None, ids=None, k=10, encoder=None, filters=None, clusters=None):
+        texts = list(texts or [])
+        ids = [int(image_id) for image_id in ids or []]
+
+        query_vectors = []
+        if texts:
+            query_vectors.append(self.run_stage('encode', self.encode_texts, texts, encoder=encoder))
+        if ids:
+            query_vectors.append(self.get_vectors_by_ids(ids))
+        if not query_vectors:
+            return []
+
+        _, indices = self.search_index(np.vstack(query_vectors), k, filters=filters)
+
+        return [self.get_image_feature_by_tuple(tuple(int(i) for i in row[row >= 0]), clusters=clusters) for row in indices]
+
+    # "A, then B shortly after": one encoder pass and one faiss search for all texts, then a join of the
+    # per-text candidates on (video, frame) keys; max_gap is in frame_mapping_index units
+    @traced('temporal_search')
+    def search_temporal(self, texts, k=10, candidates=1000, max_gap=250, encoder=None, filters=None):
+        texts = list(texts)
+        if not texts:
+            return []
+
+        query_vectors = self.run_stage('encode', self.encode_texts, texts, encoder=encoder)
+        scores, indices = self.search_index(query_vectors, candidates, filters=filters)
+
+        with self.metrics.stage('temporal_join'):
+            metadata = self.metadata
+            step_ids, step_keys, step_scores = [], [], []
+            for row_scores, row_ids in zip(scores, indices):
+                positions = metadata.positions(row_ids)
+                found = positions >= 0
+                step_ids.append(row_ids[found])
+                step_keys.append(metadata.frame_keys(positions[found]))
+                step_scores.append(row_scores[found])
+
+            sequences = join_sequences(step_keys, step_scores, max_gap, k)
+
+        ids = {int(step_ids[step][candidate]) for _, path in sequences for step, candidate in enumerate(path)}
+        rows = {row['id']: row for row in self.get_image_feature_by_tuple(tuple(ids))}
+
+        return [{
+            'score': score,
+            'frames': [rows[int(step_ids[step][candidate])] for step, candidate in enumerate(path)]
+        } for score, path in sequences]
+
+    # Gauges next to the histograms in /metrics
+    def metrics_text(self):
+        gauges = []
+        for stat in ('hits', 'misses', 'size', 'bytes'):
+            gauges += [(f'search_cache_{stat}', f'Cache {stat}', {'cache': cache}, stats[stat]) for cache, stats in self.cache_stats().items()]
+
+        if self.text_scheduler is not None:
+            for stat, value in self.text_scheduler.stats().items():
+                gauges.append((f'search_text_batching_{stat}', f'Text micro-batching {stat}', {}, value))
+
+        gauges += [('search_component_load_seconds', 'Time taken to load each engine component', {'component': name}, seconds) for name, seconds in self.load_timings.items()]
+        if self.components.get('index') is not None:
+            gauges.append(('search_index_vectors', 'Vectors in the loaded faiss index', {}, self.index.ntotal))
+
+        return self.metrics.render(gauges)
+
+    # Ids to export from a result token, ranked deeper if limit asks for more than has been paged through
+    def export_ids(self, cursor=None, ids=None, limit=None):
+        if cursor is not None:
+            # A token from another worker (or an evicted one) is ranked again from the query it encodes
+            ids = self.ranking(cursor, limit or self.EXPORT_DEPTH)['ids']
+
+        ids = np.asarray(ids if ids is not None else [], dtype=np.int64)
+        return ids[:limit] if limit else ids
+
+    # Hydrate in chunks so a large export never holds every row at once
+    def iter_rows(self, ids, chunk_size=1000, clusters=None):
+        for start in range(0, len(ids), chunk_size):
+            yield from self.get_image_feature_by_tuple(tuple(int(i) for i in ids[start:start + chunk_size]), clusters=clusters)
+
+    # Submission CSV as a stream of text chunks; rows are result objects with folder_id, child_folder_id and frame_mapping_index
+    def download_csv(self, rows, chunk_size=1000):
+        yield 'Folder,Frame index\n'
 
-        output = BytesIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
+        lines = []
+        for row in rows:
+            # L01_V001: folder ids are padded to two digits, video ids get a leading 0 on a two-digit pad
+            lines.append(f'L{row["folder_id"]:02d}_V0{row["child_folder_id"]:02d},{row["frame_mapping_index"]}\n')
+            if len(lines) == chunk_size:
+                yield ''.join(lines)
+                lines = []
 
-        return output
+        if lines:
+            yield ''.join(lines)
 
     def close(self):
-        self.db_cursor.close()
-        self.db_connection.close()
+        if self.text_scheduler is not None:
+            self.text_scheduler.close()
+        for executor in self.stage_executors.values():
+            executor.shutdown(wait=False)
+        if isinstance(self.components.get('index'), ShardedIndex):
+            self.index.close()
+        self.translation_cache.save()
+        self.embedding_cache.save()
+        self.db_pool.close()
 
 
 
@@ -0,0 +1,139 @@
+import faiss, numpy as np
+
+
+class IndexBuilder:
+    # Supported index types and the faiss factory string each one maps to
+    INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw', 'sq8', 'fp16', 'ivf_sq8')
+    # Lossy codes meant as a first stage, with the engine re-ranking from the vector store (RERANK_FACTOR)
+    # (No plain IndexPQ: it takes no SearchParameters, so filtered searches could not pass an id selector)
+    COMPRESSED_TYPES = ('ivf_pq', 'sq8', 'fp16', 'ivf_sq8')
+
+    def __init__(self, dim=768, index_type='flat', nlist=1024, pq_m=64, pq_nbits=8, hnsw_m=32, ef_construction=200, train_size=100000, seed=42):
+        if index_type not in self.INDEX_TYPES:
+            raise ValueError(f'Unknown index type {index_type}, expected one of {self.INDEX_TYPES}')
+
+        self.dim = dim
+        self.index_type = index_type
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.train_size = train_size
+        self.rng = np.random.default_rng(seed)
+
+        # Reservoir of training vectors, filled by add_training_sample
+        self.sample = np.empty((train_size, dim), dtype=np.float32)
+        self.sample_count = 0
+        self.seen = 0
+
+    def factory_string(self):
+        if self.index_type == 'flat':
+            return 'IDMap,Flat'
+        if self.index_type == 'ivf_flat':
+            return f'IVF{self.nlist},Flat'
+        if self.index_type == 'ivf_pq':
+            return f'IVF{self.nlist},PQ{self.pq_m}x{self.pq_nbits}'
+        if self.index_type == 'ivf_sq8':
+            return f'IVF{self.nlist},SQ8'
+        # 1 byte and 2 bytes per dimension
+        if self.index_type == 'sq8':
+            return 'IDMap,SQ8'
+        if self.index_type == 'fp16':
+            return 'IDMap,SQfp16'
+        return f'IDMap,HNSW{self.hnsw_m}'
+
+    def create(self):
+        index = faiss.index_factory(self.dim, self.factory_string(), faiss.METRIC_INNER_PRODUCT)
+
+        if self.index_type == 'hnsw':
+            faiss.downcast_index(index.index).hnsw.efConstruction = self.ef_construction
+
+        return index
+
+    def needs_training(self):
+        # SQ8 learns per-dimension ranges; fp16 needs no training
+        return self.index_type in ('ivf_flat', 'ivf_pq', 'sq8', 'ivf_sq8')
+
+    def add_training_sample(self, vectors):
+        # Vectorized reservoir sampling so the sample is uniform over every file seen
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n = len(vectors)
+        if n == 0:
+            return
+
+        free = min(self.train_size - self.sample_count, n)
+        if free > 0:
+            self.sample[self.sample_count:self.sample_count + free] = vectors[:free]
+            self.sample_count += free
+
+        if free < n:
+            positions = np.arange(self.seen + free, self.seen + n) + 1
+            slots = (self.rng.random(n - free) * positions).astype(np.int64)
+            keep = slots < self.train_size
+            self.sample[slots[keep]] = vectors[free:][keep]
+
+        self.seen += n
+
+    def train(self, index):
+        if not self.needs_training() or index.is_trained:
+            return index
+
+        sample = self.sample[:self.sample_count]
+        if self.index_type.startswith('ivf') and len(sample) < self.nlist * 39:
+            print(f'Warning: training {self.index_type} with {len(sample)} vectors, faiss recommends at least {self.nlist * 39} for nlist={self.nlist}')
+
+        index.train(sample)
+        return index
+
+    def build(self):
+        return self.train(self.create())
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    # Parameters the index does not have are ignored, so one config works for every index type
+    for shard in getattr(index, 'shards', [index]):
+        if nprobe is not None:
+            try:
+                faiss.extract_index_ivf(shard).nprobe = int(nprobe)
+            except RuntimeError:
+                pass
+
+        if ef_search is not None:
+            base = faiss.downcast_index(shard)
+            if isinstance(base, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+                base = faiss.downcast_index(base.index)
+            if hasattr(base, 'hnsw'):
+                base.hnsw.efSearch = int(ef_search)
+
+
+# Search parameters that restrict a search to the ids accepted by selector. Passing params replaces the
+# index's own nprobe / efSearch for that call, so the current values are copied in.
+def filtered_search_params(index, selector):
+    # Shards share one configuration, so the first one stands for a ShardedIndex
+    index = getattr(index, 'shards', [index])[0]
+    try:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(index).nprobe)
+    except RuntimeError:
+        pass
+
+    base = faiss.downcast_index(index)
+    if isinstance(base, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        base = faiss.downcast_index(base.index)
+    if hasattr(base, 'hnsw'):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch)
+
+    return faiss.SearchParameters(sel=selector)
+
+
+# Bitmap selector over ids [0, max id]: one bit per id, membership is a shift and a mask
+def bitmap_selector(ids):
+    ids = np.asarray(ids, dtype=np.int64)
+    mask = np.zeros(int(ids.max()) + 1 if len(ids) else 1, dtype=bool)
+    mask[ids] = True
+    bitmap = np.packbits(mask, bitorder='little')
+    # n is the bitmap size in bytes; ids past it are rejected
+    selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+    # faiss only keeps a pointer, so the array has to live as long as the selector
+    selector.bitmap_array = bitmap
+    return selector
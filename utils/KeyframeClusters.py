@@ -0,0 +1,31 @@
+import numpy as np
+
+
+def cluster_keyframes(vectors, frame_indices, threshold, max_gap=None):
+    # vectors are the normalized keyframes of one video in frame order. A cluster is a run of consecutive
+    # keyframes whose cosine similarity to the run's first frame stays >= threshold, and (with max_gap) no
+    # more than max_gap frames after the previous one. Comparing to the first frame rather than the previous
+    # one keeps a slow pan from chaining into a single cluster.
+    # Returns the cluster number of every row and the row of each cluster's representative: the member
+    # closest to the cluster mean.
+    vectors = np.asarray(vectors, dtype=np.float32)
+    frame_indices = np.asarray(frame_indices, dtype=np.int64)
+    labels = np.zeros(len(vectors), dtype=np.int64)
+    if len(vectors) == 0:
+        return labels, np.empty(0, dtype=np.int64)
+
+    starts = [0]
+    for row in range(1, len(vectors)):
+        gap_ok = max_gap is None or frame_indices[row] - frame_indices[row - 1] <= max_gap
+        if not gap_ok or float(vectors[row] @ vectors[starts[-1]]) < threshold:
+            starts.append(row)
+    starts = np.asarray(starts, dtype=np.int64)
+    labels[starts[1:]] = 1
+    labels = np.cumsum(labels)
+
+    ends = np.append(starts[1:], len(vectors))
+    representatives = np.empty(len(starts), dtype=np.int64)
+    for cluster, (start, end) in enumerate(zip(starts, ends)):
+        members = vectors[start:end]
+        representatives[cluster] = start + int(np.argmax(members @ members.mean(axis=0)))
+    return labels, representatives
@@ -0,0 +1,99 @@
+import os, pickle, logging, tempfile, threading, time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    # Bounded, thread-safe LRU with optional TTL and pickle persistence across restarts
+    def __init__(self, max_size=10000, ttl=None, persist_path=None, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_path = persist_path
+        # Optional memory bound, measured per value by sizeof
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if persist_path:
+            self.load()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or self._expired(item):
+                if item is not None:
+                    self._pop(key)
+                self.misses += 1
+                return default
+
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            if key in self.data:
+                self._pop(key)
+            self.data[key] = (expires_at, value)
+            self.bytes += self.sizeof(value)
+            while len(self.data) > self.max_size or (self.max_bytes and self.bytes > self.max_bytes and len(self.data) > 1):
+                self._pop(next(iter(self.data)))
+
+    def _pop(self, key):
+        _, value = self.data.pop(key)
+        self.bytes -= self.sizeof(value)
+
+    def _expired(self, item):
+        return item[0] is not None and item[0] < time.time()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'bytes': self.bytes}
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def save(self):
+        if not self.persist_path:
+            return
+
+        with self.lock:
+            items = [(key, item) for key, item in self.data.items() if not self._expired(item)]
+
+        # Write to a temporary file first so a crash never leaves a truncated cache behind. Each process gets its
+        # own file, since every gunicorn worker saves the same cache on shutdown.
+        fd, tmp_path = tempfile.mkstemp(prefix=f'{os.path.basename(self.persist_path)}.', suffix='.tmp', dir=os.path.dirname(self.persist_path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                pickle.dump(items, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.persist_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def load(self):
+        try:
+            with open(self.persist_path, 'rb') as file:
+                items = pickle.load(file)
+            loaded = OrderedDict((key, item) for key, item in items[-self.max_size:] if not self._expired(item))
+        except FileNotFoundError:
+            return
+        # Any unreadable cache (truncated, written by another version, ...) is only a cold start
+        except Exception as e:
+            logger.error(f'Error loading cache from {self.persist_path}, starting empty: {e}')
+            return
+
+        with self.lock:
+            self.data = loaded
+            self.bytes = sum(self.sizeof(item[1]) for item in loaded.values())
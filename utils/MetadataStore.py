@@ -0,0 +1,272 @@
+import os, numpy as np
+
+
+class MetadataStore:
+    # Fixed-width columns, each stored as one raw little-endian file inside the store directory
+    COLUMNS = {
+        'id': np.dtype('<i8'),
+        'folder_id': np.dtype('<i4'),
+        'child_folder_id': np.dtype('<i4'),
+        'id_frame': np.dtype('<i4'),
+        'frame_mapping_index': np.dtype('<i4'),
+        # Id of the row's near-duplicate cluster representative (insert.py --dedup-threshold), its own id otherwise.
+        # Members of a cluster are consecutive ids around the representative, so the column never decreases
+        # and a cluster's member range is one searchsorted away
+        'cluster_id': np.dtype('<i8')
+    }
+    # Frame keys are video * FRAME_SPAN + frame_mapping_index, so sorting them orders rows by video, then frame;
+    # the video number is folder_id * VIDEO_SPAN + child_folder_id
+    FRAME_SPAN = 1 << 32
+    VIDEO_SPAN = 100000
+
+    def __init__(self, path=None):
+        self.path = path
+        self.columns = {name: np.empty(0, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        # image_path is variable length: one utf-8 blob plus the end offset of every row
+        self.path_blob = np.empty(0, dtype=np.uint8)
+        self.path_offsets = np.empty(0, dtype='<i8')
+        self.frame_key_column = None
+        self.video_layout_cache = None
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    @property
+    def ids(self):
+        return self.columns['id']
+
+    @classmethod
+    def load(cls, path):
+        store = cls(path)
+        for name, dtype in cls.COLUMNS.items():
+            store.columns[name] = cls._map(os.path.join(path, f'{name}.bin'), dtype)
+        store.path_blob = cls._map(os.path.join(path, 'image_path.bin'), np.uint8)
+        store.path_offsets = cls._map(os.path.join(path, 'image_path_offsets.bin'), np.dtype('<i8'))
+        # Stores written before clustering have no cluster_id file: every row is its own cluster
+        if len(store.columns['cluster_id']) != len(store.ids):
+            store.columns['cluster_id'] = store.ids
+        store._sort()
+        return store
+
+    @classmethod
+    def from_db(cls, cursor, batch_size=50000):
+        store = cls()
+        store.load_rows_from_db(cursor, batch_size=batch_size)
+        return store
+
+    def load_rows_from_db(self, cursor, batch_size=50000):
+        # Only rows newer than the ones already loaded, so this doubles as the reload path
+        last_id = int(self.ids[-1]) if len(self) else 0
+        cursor.execute("""
+            SELECT id, folder_id, child_folder_id, id_frame, image_path, frame_mapping_index
+            FROM image_features
+            WHERE id > %s
+            ORDER BY id
+        """, (last_id,))
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            ids, folder_ids, child_folder_ids, id_frames, image_paths, frame_mapping_indices = zip(*rows)
+            self._extend(ids, folder_ids, child_folder_ids, id_frames, image_paths, frame_mapping_indices)
+
+        return self
+
+    @staticmethod
+    def _map(filepath, dtype):
+        if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filepath, dtype=dtype, mode='r')
+
+    def _sort(self):
+        # Gathers use searchsorted, so ids must be ascending; auto-increment ids already are
+        ids = self.ids
+        if len(ids) < 2 or np.all(ids[1:] > ids[:-1]):
+            return
+
+        order = np.argsort(ids, kind='stable')
+        starts = np.concatenate(([0], self.path_offsets[:-1]))
+        self.path_blob = np.concatenate([self.path_blob[starts[i]:self.path_offsets[i]] for i in order])
+        self.path_offsets = np.cumsum((self.path_offsets - starts)[order])
+        self.columns = {name: np.asarray(column)[order] for name, column in self.columns.items()}
+
+    @classmethod
+    def create(cls, path):
+        os.makedirs(path, exist_ok=True)
+        for name in list(cls.COLUMNS) + ['image_path', 'image_path_offsets']:
+            open(os.path.join(path, f'{name}.bin'), 'wb').close()
+        return cls(path)
+
+    def append(self, ids, folder_ids, child_folder_ids, id_frames, image_paths, frame_mapping_indices, cluster_ids=None):
+        columns, blob, lengths = self._encode(ids, folder_ids, child_folder_ids, id_frames, image_paths, frame_mapping_indices, cluster_ids)
+
+        self._backfill_clusters()
+        base = self._stored_blob_size()
+        for name, column in columns.items():
+            with open(os.path.join(self.path, f'{name}.bin'), 'ab') as file:
+                file.write(column.tobytes())
+        with open(os.path.join(self.path, 'image_path.bin'), 'ab') as file:
+            file.write(blob.tobytes())
+        with open(os.path.join(self.path, 'image_path_offsets.bin'), 'ab') as file:
+            file.write((base + np.cumsum(lengths)).astype('<i8').tobytes())
+
+    # An incremental insert into a store written before clustering first gives the stored rows their own ids
+    def _backfill_clusters(self):
+        ids_file = os.path.join(self.path, 'id.bin')
+        cluster_file = os.path.join(self.path, 'cluster_id.bin')
+        # A store being started by this append has nothing to backfill
+        if not os.path.exists(ids_file):
+            return
+        stored = os.path.getsize(cluster_file) if os.path.exists(cluster_file) else 0
+        if stored < os.path.getsize(ids_file):
+            with open(ids_file, 'rb') as source, open(cluster_file, 'ab') as file:
+                source.seek(stored)
+                file.write(source.read())
+
+    # Copy the store at path into target without the rows whose id falls in one of the inclusive (first, last)
+    # ranges. The files at path are only read, so a server that has them mapped keeps working; rows a crashed
+    # append left in some columns but not others are at the end and dropped too. Returns the number of rows dropped.
+    @classmethod
+    def compact(cls, path, target, ranges):
+        os.makedirs(target, exist_ok=True)
+        ids_file = os.path.join(path, 'id.bin')
+        ids = np.fromfile(ids_file, dtype='<i8') if os.path.exists(ids_file) else np.empty(0, dtype='<i8')
+        keep = np.ones(len(ids), dtype=bool)
+        for first, last in ranges:
+            keep &= (ids < first) | (ids > last)
+
+        for name, dtype in cls.COLUMNS.items():
+            filepath = os.path.join(path, f'{name}.bin')
+            if os.path.exists(filepath):
+                cls._select(np.fromfile(filepath, dtype=dtype), keep).tofile(os.path.join(target, f'{name}.bin'))
+
+        # image_path bytes are kept or dropped together with their row
+        ends = cls._select(np.fromfile(os.path.join(path, 'image_path_offsets.bin'), dtype='<i8'), np.ones(len(ids), dtype=bool))
+        lengths = np.diff(ends, prepend=0)
+        blob = np.fromfile(os.path.join(path, 'image_path.bin'), dtype=np.uint8)[:int(ends[-1]) if len(ends) else 0]
+        blob[np.repeat(keep[:len(ends)], lengths)].tofile(os.path.join(target, 'image_path.bin'))
+        np.cumsum(cls._select(lengths, keep)).astype('<i8').tofile(os.path.join(target, 'image_path_offsets.bin'))
+        return int((~keep).sum())
+
+    # Rows of a column selected by a mask over id.bin, ignoring rows the column has beyond it
+    @staticmethod
+    def _select(column, keep):
+        return column[:len(keep)][keep[:len(column)]]
+
+    def _stored_blob_size(self):
+        filepath = os.path.join(self.path, 'image_path.bin')
+        return os.path.getsize(filepath) if os.path.exists(filepath) else 0
+
+    def _extend(self, ids, folder_ids, child_folder_ids, id_frames, image_paths, frame_mapping_indices, cluster_ids=None):
+        columns, blob, lengths = self._encode(ids, folder_ids, child_folder_ids, id_frames, image_paths, frame_mapping_indices, cluster_ids)
+
+        base = self.path_offsets[-1] if len(self.path_offsets) else 0
+        self.columns = {name: np.concatenate((self.columns[name], columns[name])) for name in self.COLUMNS}
+        self.path_blob = np.concatenate((self.path_blob, blob))
+        self.path_offsets = np.concatenate((self.path_offsets, base + np.cumsum(lengths)))
+        self.frame_key_column = None
+        self.video_layout_cache = None
+        self._sort()
+
+    def _encode(self, ids, folder_ids, child_folder_ids, id_frames, image_paths, frame_mapping_indices, cluster_ids=None):
+        values = {
+            'id': ids,
+            'folder_id': folder_ids,
+            'child_folder_id': child_folder_ids,
+            'id_frame': id_frames,
+            'frame_mapping_index': frame_mapping_indices,
+            'cluster_id': ids if cluster_ids is None else cluster_ids
+        }
+        columns = {name: np.asarray(values[name], dtype=dtype) for name, dtype in self.COLUMNS.items()}
+
+        encoded = [str(image_path).encode('utf-8') for image_path in image_paths]
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        lengths = np.array([len(image_path) for image_path in encoded], dtype='<i8')
+        return columns, blob, lengths
+
+    def positions(self, ids):
+        # Row position of every id, -1 where the id is unknown (including faiss' -1 padding)
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if len(self) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self) - 1)
+        return np.where(self.ids[positions] == ids, positions, -1)
+
+    def image_paths(self, positions):
+        ends = self.path_offsets[positions]
+        starts = np.where(positions > 0, self.path_offsets[np.maximum(positions - 1, 0)], 0)
+        return [self.path_blob[start:end].tobytes().decode('utf-8') for start, end in zip(starts, ends)]
+
+    def gather(self, ids):
+        positions = self.positions(ids)
+        positions = positions[positions >= 0]
+
+        columns = {name: self.columns[name][positions].tolist() for name in self.COLUMNS}
+        image_paths = self.image_paths(positions)
+        starts, ends = self.cluster_ranges(columns['cluster_id'])
+        cluster_sizes = np.maximum(ends - starts, 1).tolist()
+
+        return [{
+            'id': columns['id'][i],
+            'folder_id': columns['folder_id'][i],
+            'child_folder_id': columns['child_folder_id'][i],
+            'id_frame': columns['id_frame'][i],
+            'image_path': image_paths[i],
+            'frame_mapping_index': columns['frame_mapping_index'][i],
+            'cluster_id': columns['cluster_id'][i],
+            'cluster_size': cluster_sizes[i]
+        } for i in range(len(positions))]
+
+    # Row range [start, end) of the cluster of each representative id; empty for ids that represent nothing
+    def cluster_ranges(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        clusters = self.columns['cluster_id']
+        return np.searchsorted(clusters, ids, side='left'), np.searchsorted(clusters, ids, side='right')
+
+    # Member ids of each cluster in frame order, clusters in the given order; an id outside every cluster
+    # (e.g. a member searched by id) stands for itself
+    def cluster_members(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        starts, ends = self.cluster_ranges(ids)
+        members = [self.ids[start:end] if end > start else ids[i:i + 1] for i, (start, end) in enumerate(zip(starts, ends))]
+        return np.concatenate(members) if members else np.empty(0, dtype=np.int64)
+
+    # Built once per loaded store; candidates from any query map to comparable (video, frame) keys with one gather
+    def frame_keys(self, positions):
+        if self.frame_key_column is None:
+            videos = self.columns['folder_id'].astype(np.int64) * self.VIDEO_SPAN + self.columns['child_folder_id']
+            self.frame_key_column = videos * self.FRAME_SPAN + self.columns['frame_mapping_index']
+        return self.frame_key_column[positions]
+
+    # Row positions grouped per video and frame-sorted: rows of video videos[i] are order[starts[i]:ends[i]]
+    def video_layout(self):
+        if self.video_layout_cache is None:
+            keys = self.frame_keys(slice(None))
+            order = np.argsort(keys, kind='stable')
+            videos = keys[order] // self.FRAME_SPAN
+            starts = np.flatnonzero(np.concatenate(([True], videos[1:] != videos[:-1]))) if len(videos) else np.empty(0, dtype=np.int64)
+            ends = np.append(starts[1:], len(order))
+            self.video_layout_cache = (videos[starts], starts, ends, order)
+        return self.video_layout_cache
+
+    # Sorted ids of rows with folder_id in folders and child_folder_id in child_folders (either may be None
+    # for any), plus every row of the (folder_id, child_folder_id) pairs in videos
+    def ids_in_videos(self, folders=None, child_folders=None, videos=None):
+        video_numbers, starts, ends, order = self.video_layout()
+
+        selected = np.zeros(len(video_numbers), dtype=bool)
+        if folders is not None or child_folders is not None:
+            selected[:] = True
+            if folders is not None:
+                selected &= np.isin(video_numbers // self.VIDEO_SPAN, folders)
+            if child_folders is not None:
+                selected &= np.isin(video_numbers % self.VIDEO_SPAN, child_folders)
+        if videos:
+            selected |= np.isin(video_numbers, [folder_id * self.VIDEO_SPAN + child_folder_id for folder_id, child_folder_id in videos])
+
+        if not selected.any():
+            return np.empty(0, dtype=np.int64)
+        positions = np.concatenate([order[start:end] for start, end in zip(starts[selected], ends[selected])])
+        return np.sort(np.asarray(self.ids[positions], dtype=np.int64))
@@ -0,0 +1,149 @@
+import bisect, functools, inspect, json, logging, random, threading, time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    # Latency buckets in seconds, from cache hits up to a cold model load
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = {labels: ([*counts], total) for labels, (counts, total) in self.series.items()}
+
+        for label_values, (counts, total) in sorted(series.items()):
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            prefix = f'{labels},' if labels else ''
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+
+class Metrics:
+    # Per-stage and per-request latency histograms, plus a per-stage trace of sampled slow requests
+    def __init__(self, slow_threshold=None, sample_rate=1.0, trace_path=None, max_traces=100):
+        self.request_seconds = Histogram('search_request_seconds', 'End-to-end latency of engine operations', ('operation',))
+        self.stage_seconds = Histogram('search_stage_seconds', 'Latency of each search stage', ('stage',))
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.trace_path = trace_path
+        self.slow_traces = deque(maxlen=max_traces)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    # attributes is a dict, or a callable returning one that is only evaluated for dumped traces
+    @contextmanager
+    def trace(self, operation, attributes=None):
+        # Nested operations are timed as part of the outer one
+        if self.current() is not None:
+            yield self.current()
+            return
+
+        trace = {'operation': operation, 'attributes': attributes, 'start': time.perf_counter(), 'stages': []}
+        self.local.trace = trace
+        try:
+            yield trace
+        finally:
+            self.local.trace = None
+            elapsed = time.perf_counter() - trace['start']
+            self.request_seconds.observe(elapsed, operation)
+            if self.slow_threshold is not None and elapsed >= self.slow_threshold and random.random() < self.sample_rate:
+                self.dump(trace, elapsed)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stage_seconds.observe(elapsed, name)
+            trace = self.current()
+            if trace is not None:
+                trace['stages'].append((name, start - trace['start'], elapsed))
+
+    # Run on another thread (stage executors) while recording into the caller's trace
+    def run_in(self, trace, function, *args, **kwargs):
+        self.local.trace = trace
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.local.trace = None
+
+    def dump(self, trace, elapsed):
+        attributes = trace['attributes']
+        record = {
+            'operation': trace['operation'],
+            'attributes': attributes() if callable(attributes) else attributes,
+            'total_ms': round(elapsed * 1000, 3),
+            'stages': [{'stage': name, 'start_ms': round(start * 1000, 3), 'ms': round(duration * 1000, 3)} for name, start, duration in trace['stages']]
+        }
+        self.slow_traces.append(record)
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        logger.warning('Slow %s: %s', trace['operation'], line)
+
+        if self.trace_path:
+            with self.lock, open(self.trace_path, 'a', encoding='utf-8') as file:
+                file.write(line + '\n')
+
+    # Prometheus text exposition; gauges is a list of (name, description, {label: value}, value)
+    def render(self, gauges=()):
+        lines = self.request_seconds.render() + self.stage_seconds.render()
+
+        described = set()
+        for name, description, labels, value in gauges:
+            if name not in described:
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} gauge']
+                described.add(name)
+            label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# Method decorator: runs the call inside a trace on self.metrics, with the call arguments as attributes.
+# operation is the name the call is timed under, or a function of self and the arguments that returns it.
+def traced(operation):
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            def attributes():
+                arguments = signature.bind(self, *args, **kwargs).arguments
+                return {name: value for name, value in arguments.items() if name != 'self'}
+
+            name = operation(self, attributes()) if callable(operation) else operation
+            with self.metrics.trace(name, attributes):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,102 @@
+import os, json, threading, faiss, numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def shard_of(shard_by, shard_count, folder_id, ids):
+    # Shard of every id: all frames of an Lxx folder together, or ids spread evenly
+    ids = np.asarray(ids, dtype=np.int64)
+    if shard_by == 'folder':
+        return np.full(len(ids), folder_id % shard_count, dtype=np.int64)
+    return ids % shard_count
+
+
+def shard_paths(shards_path, shard_count):
+    stem = os.path.splitext(shards_path)[0]
+    return [f'{stem}{i:02d}.bin' for i in range(shard_count)]
+
+
+class ShardedIndex:
+    # Several faiss indexes searched in parallel with their top-k merged; each shard can be swapped on its own
+    SHARD_BY = ('folder', 'hash')
+
+    def __init__(self, shards_path, shard_by, paths, indexes, io_flags=0, workers=None):
+        self.shards_path = shards_path
+        self.shard_by = shard_by
+        self.paths = paths
+        self.io_flags = io_flags
+        # Replaced as a whole, never mutated, so a search sees one consistent list of shards
+        self.shards = list(indexes)
+        self.mtimes = [os.path.getmtime(path) if os.path.exists(path) else None for path in paths]
+        self.lock = threading.Lock()
+        # faiss releases the GIL while searching, so threads run the shards concurrently
+        self.executor = ThreadPoolExecutor(max_workers=workers or len(paths), thread_name_prefix='shard')
+
+    @classmethod
+    def load(cls, shards_path, io_flags=0, workers=None):
+        with open(shards_path, 'r') as file:
+            layout = json.load(file)
+
+        folder = os.path.dirname(shards_path)
+        paths = [os.path.join(folder, filename) for filename in layout['shards']]
+        with ThreadPoolExecutor(max_workers=workers or len(paths)) as executor:
+            indexes = list(executor.map(lambda path: faiss.read_index(path, io_flags), paths))
+        return cls(shards_path, layout['shard_by'], paths, indexes, io_flags=io_flags, workers=workers)
+
+    @staticmethod
+    def write_layout(shards_path, shard_by, paths):
+        with open(f'{shards_path}.tmp', 'w') as file:
+            json.dump({'shard_by': shard_by, 'shards': [os.path.basename(path) for path in paths]}, file, indent=4)
+        os.replace(f'{shards_path}.tmp', shards_path)
+
+    @property
+    def ntotal(self):
+        return sum(shard.ntotal for shard in self.shards)
+
+    @property
+    def d(self):
+        return self.shards[0].d
+
+    @property
+    def metric_type(self):
+        return self.shards[0].metric_type
+
+    def search(self, x, k, params=None):
+        shards = self.shards
+        futures = [self.executor.submit(shard.search, x, k, params=params) for shard in shards]
+        results = [future.result() for future in futures]
+
+        distances = np.hstack([distances for distances, _ in results])
+        indices = np.hstack([indices for _, indices in results])
+
+        # Inner product ranks high to low, L2 low to high; faiss pads missing hits so they sort last
+        keys = -distances if self.metric_type == faiss.METRIC_INNER_PRODUCT else distances
+        order = np.argsort(keys, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    # False when insert.py wrote a different shard count or split, which needs a full load
+    def same_layout(self):
+        with open(self.shards_path, 'r') as file:
+            layout = json.load(file)
+        return layout['shard_by'] == self.shard_by and layout['shards'] == [os.path.basename(path) for path in self.paths]
+
+    # Re-read only the shard files insert.py rewrote; searches keep running on the other shards meanwhile.
+    # prepare is applied to each new shard before it is swapped in (e.g. nprobe / efSearch).
+    def reload_changed(self, prepare=None):
+        reloaded = []
+        with self.lock:
+            for i, path in enumerate(self.paths):
+                mtime = os.path.getmtime(path)
+                if mtime == self.mtimes[i]:
+                    continue
+                shard = faiss.read_index(path, self.io_flags)
+                if prepare is not None:
+                    prepare(shard)
+                shards = list(self.shards)
+                shards[i] = shard
+                self.shards = shards
+                self.mtimes[i] = mtime
+                reloaded.append(i)
+        return reloaded
+
+    def close(self):
+        self.executor.shutdown(wait=False)
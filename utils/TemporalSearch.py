@@ -0,0 +1,52 @@
+import numpy as np
+from collections import deque
+
+
+def join_sequences(step_keys, step_scores, max_gap, k):
+    # step_keys[i] and step_scores[i] are the frame keys (MetadataStore.frame_keys) and similarities of the
+    # candidates for query i. A sequence takes one candidate per query, in query order, all in one video, each
+    # 1..max_gap frames after the previous one; its score is the sum of similarities. Returns the k best as
+    # (score, [candidate index per query]), keeping only the best sequence ending at each last-step candidate.
+    order = np.argsort(step_keys[0], kind='stable')
+    keys = step_keys[0][order]
+    best = np.asarray(step_scores[0], dtype=np.float64)[order]
+    orders, backs = [order], []
+
+    for step in range(1, len(step_keys)):
+        order = np.argsort(step_keys[step], kind='stable')
+        step_sorted = step_keys[step][order]
+
+        # Both key lists are sorted, so the window of predecessors [key - max_gap, key) only moves forward
+        # and a monotonic deque gives its best entry in O(1) amortized
+        lo = np.searchsorted(keys, step_sorted - max_gap, side='left')
+        hi = np.searchsorted(keys, step_sorted, side='left')
+        back = np.full(len(step_sorted), -1, dtype=np.int64)
+        window = deque()
+        j = 0
+        for i in range(len(step_sorted)):
+            while j < hi[i]:
+                while window and best[window[-1]] <= best[j]:
+                    window.pop()
+                window.append(j)
+                j += 1
+            while window and window[0] < lo[i]:
+                window.popleft()
+            if window:
+                back[i] = window[0]
+
+        reachable = back >= 0
+        keys = step_sorted[reachable]
+        back = back[reachable]
+        best = np.asarray(step_scores[step], dtype=np.float64)[order][reachable] + best[back]
+        orders.append(order[reachable])
+        backs.append(back)
+
+    sequences = []
+    for position in np.argsort(-best, kind='stable')[:k]:
+        score = float(best[position])
+        path = [int(orders[-1][position])]
+        for step in range(len(backs) - 1, -1, -1):
+            position = backs[step][position]
+            path.append(int(orders[step][position]))
+        sequences.append((score, path[::-1]))
+    return sequences
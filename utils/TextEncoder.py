@@ -0,0 +1,112 @@
+import os, logging, numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ClipTextEncoder:
+    # 'torch' is the fp32 reference; 'int8' and 'onnx' are CPU-only and checked against it with parity()
+    BACKENDS = ('torch', 'int8', 'onnx')
+
+    # Text tower and tokenizer only; serving never touches the vision tower or the image processor
+    def __init__(self, model_name='openai/clip-vit-large-patch14', device='cpu', backend='torch', num_threads=None, onnx_path=None):
+        import torch
+        from transformers import CLIPTextModelWithProjection, CLIPTokenizer
+
+        if backend not in self.BACKENDS:
+            raise ValueError(f'Unknown CLIP text backend {backend}, expected one of {self.BACKENDS}')
+        if backend != 'torch' and device != 'cpu':
+            raise ValueError(f'The {backend} backend only runs on CPU')
+
+        # Pinned so concurrent requests do not oversubscribe the cores
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.torch = torch
+        self.model_name = model_name
+        self.device = device
+        self.backend = backend
+        self.tokenizer = CLIPTokenizer.from_pretrained(model_name)
+        self.model = CLIPTextModelWithProjection.from_pretrained(model_name).to(device).eval()
+        self.session = None
+
+        if backend == 'int8':
+            # Linear layers hold nearly all the weights; activations are quantized on the fly per batch
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == 'onnx':
+            onnx_path = onnx_path or f'{model_name.replace("/", "_")}_text.onnx'
+            if not os.path.exists(onnx_path):
+                self.export_onnx(onnx_path)
+            self.session = self.create_session(onnx_path, num_threads)
+            self.model = None
+
+    def export_onnx(self, onnx_path):
+        torch = self.torch
+
+        class TextEmbeds(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, input_ids, attention_mask):
+                return self.model(input_ids=input_ids, attention_mask=attention_mask).text_embeds
+
+        inputs = self.tokenizer(['a photo of a dog'], padding=True, return_tensors='pt')
+        tmp_path = f'{onnx_path}.tmp'
+        torch.onnx.export(
+            TextEmbeds(self.model),
+            (inputs['input_ids'], inputs['attention_mask']),
+            tmp_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['text_embeds'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'text_embeds': {0: 'batch'}},
+            opset_version=14
+        )
+        os.replace(tmp_path, onnx_path)
+        logger.info(f'Exported {self.model_name} text tower to {onnx_path}')
+
+    def create_session(self, onnx_path, num_threads):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        return onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def encode(self, texts):
+        if self.session is not None:
+            inputs = self.tokenizer(list(texts), padding=True, truncation=True, return_tensors='np')
+            text_embeddings = self.session.run(['text_embeds'], {
+                'input_ids': inputs['input_ids'].astype(np.int64),
+                'attention_mask': inputs['attention_mask'].astype(np.int64)
+            })[0].astype(np.float32)
+        else:
+            text_tokenized = self.tokenizer(list(texts), padding=True, truncation=True, return_tensors='pt').to(self.device)
+            with self.torch.no_grad():
+                text_embeddings = self.model(**text_tokenized).text_embeds.cpu().numpy().astype(np.float32)
+
+        return text_embeddings / np.linalg.norm(text_embeddings, axis=1, keepdims=True)
+
+    # Cosine similarity of each embedding to the fp32 model's
+    def parity(self, texts, reference=None):
+        reference = reference or ClipTextEncoder(self.model_name, backend='torch')
+        return np.sum(self.encode(texts) * reference.encode(texts), axis=1)
+
+
+class MultilingualTextEncoder:
+    # Multilingual student distilled into the CLIP ViT-L/14 text space, so Vietnamese
+    # queries are embedded directly without translation or preprocessing
+    def __init__(self, model_name, device='cpu', dim=768, batch_size=64):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device=device)
+        self.batch_size = batch_size
+
+        model_dim = self.model.get_sentence_embedding_dimension()
+        if model_dim != dim:
+            raise ValueError(f'{model_name} produces {model_dim}-d embeddings, the image index expects {dim}-d')
+
+    def encode(self, texts):
+        embeddings = self.model.encode(list(texts), batch_size=self.batch_size, convert_to_numpy=True, normalize_embeddings=True)
+        return embeddings.astype(np.float32)
@@ -1,25 +1,77 @@
-import string, re, inflect, nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from nltk.stem import WordNetLemmatizer
-from nltk.stem.porter import PorterStemmer
+import string, re, inflect
+from functools import lru_cache
 
 # nltk.download('punkt_tab')
 # nltk.download('woednet')
 # nltk.download('stopwords')
 
 class TextProcessor():
-    def __init__(self):
+    # Stages in pipeline order; pass a subset to turn the others off
+    STAGES = ('remove_whitespace', 'remove_punctuation', 'convert_number', 'lowercase', 'remove_stopwords', 'stemming', 'lemmatizer')
+    # Only tidies whitespace, so CLIP sees the query as written
+    NATURAL_STAGES = ('remove_whitespace',)
+
+    # Same split as word_tokenize on the text left after punctuation removal and number conversion
+    TOKEN_PATTERN = re.compile(r"\w+(?:-\w+)*|[^\w\s]")
+    # Words word_tokenize splits in two, with the split position
+    CONTRACTIONS = {'cannot': 3, 'gimme': 3, 'gonna': 3, 'gotta': 3, 'lemme': 3, 'wanna': 3}
+
+    def __init__(self, stages=None, cache_size=100000):
         self.re = re
-        self.p = inflect.engine()
-        self.word_tokenize = word_tokenize
-        self.stop_words = set(stopwords.words("english"))
-        self.wordnet_lemmatizer = WordNetLemmatizer()
-        self.porter_stemmer = PorterStemmer()
+        self.stages = set(self.STAGES if stages is None else stages)
+        unknown = self.stages - set(self.STAGES)
+        if unknown:
+            raise ValueError(f'Unknown text processing stages {sorted(unknown)}')
+
+        self.punctuation_table = str.maketrans('', '', string.punctuation)
+        self._p = None
+        self._stop_words = None
+        self._wordnet_lemmatizer = None
+        self._porter_stemmer = None
+
+        # Queries reuse a small vocabulary, so per-token results are memoized
+        self.number_tokens = lru_cache(maxsize=cache_size)(self._number_tokens)
+        self.normalize_token = lru_cache(maxsize=cache_size)(self._normalize_token)
+
+    @classmethod
+    def natural(cls, **kwargs):
+        return cls(stages=cls.NATURAL_STAGES, **kwargs)
+
+    # NLTK and inflect resources load on first use instead of at construction
+    @property
+    def p(self):
+        if self._p is None:
+            self._p = inflect.engine()
+        return self._p
+
+    @property
+    def stop_words(self):
+        if self._stop_words is None:
+            from nltk.corpus import stopwords
+            self._stop_words = set(stopwords.words("english"))
+        return self._stop_words
+
+    @property
+    def wordnet_lemmatizer(self):
+        if self._wordnet_lemmatizer is None:
+            from nltk.stem import WordNetLemmatizer
+            self._wordnet_lemmatizer = WordNetLemmatizer()
+        return self._wordnet_lemmatizer
+
+    @property
+    def porter_stemmer(self):
+        if self._porter_stemmer is None:
+            from nltk.stem.porter import PorterStemmer
+            self._porter_stemmer = PorterStemmer()
+        return self._porter_stemmer
+
+    def word_tokenize(self, text:str):
+        from nltk.tokenize import word_tokenize
+        return word_tokenize(text)
 
     def lowercase(self, text:str):
         return text.lower()
-    
+
     def convert_number(self, text:str):
         temp_str = text.split()
         new_string = []
@@ -34,20 +86,19 @@ class TextProcessor():
         return " ".join(new_string)
 
     def remove_punctuation(self, text:str):
-        translator = str.maketrans('', '', string.punctuation)
-        return text.translate(translator)
-    
+        return text.translate(self.punctuation_table)
+
     def remove_whitespace(self, text:str):
         return ' '.join(text.split())
-    
+
     def tokenize(self, text:str):
         word_tokens = self.word_tokenize(text)
         return word_tokens
-    
+
     def remove_stopwords(self, tokens):
         filtered_text = [token for token in tokens if token not in self.stop_words]
         return filtered_text
-    
+
     def stemming(self, tokens):
         stem_text = [self.porter_stemmer.stem(token) for token in tokens]
         return stem_text
@@ -56,8 +107,8 @@ class TextProcessor():
         lemm_text = [self.wordnet_lemmatizer.lemmatize(token) for token in tokens]
         return lemm_text
 
-
-    def __call__(self, text:str):
+    # The original eight-pass pipeline, kept as the reference for benchmark_text.py
+    def process_stepwise(self, text:str):
         text = self.remove_whitespace(text)
         text = self.remove_punctuation(text)
         text = self.convert_number(text)
@@ -66,4 +117,53 @@ class TextProcessor():
         tokens = self.remove_stopwords(tokens)
         tokens = self.stemming(tokens)
         tokens = self.lemmatizer(tokens)
-        return " ".join(tokens)
\ No newline at end of file
+        return " ".join(tokens)
+
+    def _number_tokens(self, word:str):
+        words = self.p.number_to_words(word)
+        if 'lowercase' in self.stages:
+            words = words.lower()
+        return tuple(self.TOKEN_PATTERN.findall(words))
+
+    def _normalize_token(self, token:str):
+        # None drops the token
+        if 'remove_stopwords' in self.stages and token in self.stop_words:
+            return None
+        if 'stemming' in self.stages:
+            token = self.porter_stemmer.stem(token)
+        if 'lemmatizer' in self.stages:
+            token = self.wordnet_lemmatizer.lemmatize(token)
+        return token
+
+    def __call__(self, text:str):
+        # Natural text for CLIP: no tokenization, nothing to memoize
+        if self.stages <= {'remove_whitespace', 'remove_punctuation', 'lowercase'}:
+            if 'remove_punctuation' in self.stages:
+                text = text.translate(self.punctuation_table)
+            if 'lowercase' in self.stages:
+                text = text.lower()
+            return ' '.join(text.split()) if 'remove_whitespace' in self.stages else text
+
+        if 'remove_punctuation' in self.stages:
+            text = text.translate(self.punctuation_table)
+
+        tokens = []
+        for word in text.split():
+            if 'convert_number' in self.stages and word.isdigit():
+                words = self.number_tokens(word)
+            else:
+                words = self.TOKEN_PATTERN.findall(word.lower() if 'lowercase' in self.stages else word)
+
+            for word_token in words:
+                split = self.CONTRACTIONS.get(word_token.lower())
+                for token in (word_token[:split], word_token[split:]) if split else (word_token,):
+                    token = self.normalize_token(token)
+                    if token is not None:
+                        tokens.append(token)
+
+        return " ".join(tokens)
+
+    def process_batch(self, texts):
+        # Repeated queries in a batch are processed once
+        processed = {text: self(text) for text in dict.fromkeys(texts)}
+        return [processed[text] for text in texts]
@@ -1,25 +1,164 @@
-import translate
+import json, logging, threading, time, concurrent.futures, translate
 from deep_translator import GoogleTranslator
+from utils.LRUCache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class LocalTranslator:
+    # Offline MarianMT model on CPU, greedy decoding to keep per-query latency low.
+    # The model loads on the first translation, not when app.py is imported.
+    def __init__(self, model_name='Helsinki-NLP/opus-mt-vi-en', device='cpu', num_threads=None, max_new_tokens=64):
+        self.model_name = model_name
+        self.device = device
+        self.num_threads = num_threads
+        self.max_new_tokens = max_new_tokens
+        self.torch = None
+        self.tokenizer = None
+        self.model = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.model is not None:
+                return
+            import torch
+            from transformers import MarianMTModel, MarianTokenizer
+
+            if self.num_threads:
+                torch.set_num_threads(self.num_threads)
+
+            start = time.perf_counter()
+            self.torch = torch
+            self.tokenizer = MarianTokenizer.from_pretrained(self.model_name)
+            self.model = MarianMTModel.from_pretrained(self.model_name).to(self.device).eval()
+            logger.info(f'Loaded {self.model_name} in {time.perf_counter() - start:.2f}s')
+
+    def translate_batch(self, texts):
+        if self.model is None:
+            self.load()
+        inputs = self.tokenizer(texts, padding=True, truncation=True, return_tensors='pt').to(self.device)
+        with self.torch.no_grad():
+            outputs = self.model.generate(**inputs, num_beams=1, max_new_tokens=self.max_new_tokens)
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def translate(self, text):
+        return self.translate_batch([text])[0]
+
 
 class Translation():
-    def __init__(self, from_lang='vi', to_lang='en', mode='deep_translator'):
+    def __init__(self, from_lang='vi', to_lang='en', mode='deep_translator', fallback_mode=None, phrase_table=None, latency_budget=None, cache_size=10000, local_model='Helsinki-NLP/opus-mt-vi-en'):
         self.__mode = mode
         self.__from_lang = from_lang
         self.__to_lang = to_lang
-        self.translator = None
+        self.translator = self.create_translator(mode, local_model)
+        # Used when the primary backend fails or runs past latency_budget seconds
+        self.fallback = self.create_translator(fallback_mode, local_model) if fallback_mode else None
+        self.latency_budget = latency_budget
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2) if latency_budget else None
+        self.cache = LRUCache(max_size=cache_size)
+        # Exact-match vi -> en table, e.g. exported from past query translations
+        self.phrase_table = self.load_phrase_table(phrase_table) if phrase_table else {}
+
+    # Backend and languages, part of the key of embeddings cached from translated queries
+    @property
+    def fingerprint(self):
+        return (self.__mode, self.__from_lang, self.__to_lang)
+
+    def create_translator(self, mode, local_model):
+        if mode == 'deep_translator':
+            return GoogleTranslator(source=self.__from_lang, target=self.__to_lang)
+        if mode == 'local':
+            return LocalTranslator(model_name=local_model)
+        return translate.Translator(from_lang=self.__from_lang, to_lang=self.__to_lang)
+
+    # Backends with a model (LocalTranslator) load it on first use; warmup loads it ahead of the first query
+    def warmup(self):
+        for backend in (self.translator, self.fallback):
+            if hasattr(backend, 'load'):
+                backend.load()
+
+    @property
+    def ready(self):
+        return all(backend.model is not None for backend in (self.translator, self.fallback) if hasattr(backend, 'load'))
+
+    def load_phrase_table(self, filepath):
+        with open(filepath, 'r', encoding='utf-8') as file:
+            return {self.preprocessing(source): target for source, target in json.load(file).items()}
 
-        if self.__mode == 'deep_translator':
-            self.translator = GoogleTranslator(source=self.__from_lang, target=self.__to_lang)
-        else:
-            self.translator = translate.Translator(from_lang=self.__from_lang, to_lang=self.__to_lang)
+    # Everything translated so far, plus translations (query -> translation, e.g. the engine's persisted
+    # translation cache), to seed the phrase table of the next deployment; see export_phrase_table.py
+    def export_phrase_table(self, filepath, translations=None):
+        table = dict(self.phrase_table)
+        with self.cache.lock:
+            table.update({key: item[1] for key, item in self.cache.data.items()})
+        # Queries that came back unchanged were English or untranslated, and would only shadow the backend
+        table.update({self.preprocessing(source): target for source, target in (translations or {}).items() if target.lower() != source.lower()})
+        with open(filepath, 'w', encoding='utf-8') as file:
+            json.dump(table, file, ensure_ascii=False, indent=4)
 
     def preprocessing(self, text):
         if isinstance(text, str):
             return text.lower()
         return text
-    
-    def __call__(self, text):
-        text = self.preprocessing(text)
-        if not isinstance(text, str):
+
+    def lookup(self, text):
+        if text in self.phrase_table:
+            return self.phrase_table[text]
+        return self.cache.get(text)
+
+    def run_backend(self, texts):
+        if hasattr(self.translator, 'translate_batch'):
+            return self.translator.translate_batch(texts)
+        return [self.translator.translate(text) for text in texts]
+
+    def run_fallback(self, texts):
+        if hasattr(self.fallback, 'translate_batch'):
+            return self.fallback.translate_batch(texts)
+        return [self.fallback.translate(text) for text in texts]
+
+    def run_with_budget(self, texts):
+        if not self.executor:
+            return self.run_backend(texts)
+
+        future = self.executor.submit(self.run_backend, texts)
+        try:
+            return future.result(timeout=self.latency_budget)
+        except concurrent.futures.TimeoutError:
+            # Let the slow call finish in the background so its result still lands in the cache
+            future.add_done_callback(lambda done: done.exception() is None and self.store(texts, done.result()))
+            raise
+
+    def store(self, texts, translations):
+        for text, translated_text in zip(texts, translations):
+            self.cache.put(text, translated_text)
+
+    def translate_batch(self, texts):
+        texts = [self.preprocessing(text) for text in texts]
+        if not all(isinstance(text, str) for text in texts):
             raise ValueError('Input text should be a string')
-        return self.translator.translate(text)
\ No newline at end of file
+
+        results = [self.lookup(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+
+        if missing:
+            try:
+                translations = self.run_with_budget(missing)
+                self.store(missing, translations)
+            except concurrent.futures.TimeoutError:
+                logger.warning(f'Translation backend {self.__mode} exceeded its {self.latency_budget}s budget')
+                # Without a fallback the untranslated query still goes to CLIP rather than failing the request
+                translations = self.run_fallback(missing) if self.fallback else missing
+            except Exception as e:
+                if not self.fallback:
+                    raise
+                logger.warning(f'Translation backend {self.__mode} failed, using fallback: {e!r}')
+                translations = self.run_fallback(missing)
+
+            translated = dict(zip(missing, translations))
+            results = [translated[text] if result is None else result for text, result in zip(texts, results)]
+
+        return results
+
+    def __call__(self, text):
+        return self.translate_batch([text])[0]
@@ -0,0 +1,99 @@
+import os, numpy as np
+
+
+class VectorStore:
+    # Normalized float32 vectors in id order, memory-mapped so every worker shares the page cache
+    def __init__(self, path, ids=None, vectors=None, dim=768):
+        self.path = path
+        self.dim = dim
+        self.ids = ids if ids is not None else np.empty(0, dtype='<i8')
+        self.vectors = vectors if vectors is not None else np.empty((0, dim), dtype='<f4')
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def create(cls, path, dim=768):
+        os.makedirs(path, exist_ok=True)
+        for name in ('ids', 'vectors'):
+            open(os.path.join(path, f'{name}.bin'), 'wb').close()
+        return cls(path, dim=dim)
+
+    # dim comes from the caller rather than the file sizes: insert.py appends ids before vectors, so a store
+    # read mid-ingest has ids without their vector. Only the rows complete in both files are mapped.
+    @classmethod
+    def load(cls, path, dim=768):
+        ids_file = os.path.join(path, 'ids.bin')
+        vectors_file = os.path.join(path, 'vectors.bin')
+        rows = min(os.path.getsize(ids_file) // 8, os.path.getsize(vectors_file) // (4 * dim))
+        if rows == 0:
+            return cls(path, dim=dim)
+
+        ids = np.memmap(ids_file, dtype='<i8', mode='r', shape=(rows,))
+        vectors = np.memmap(vectors_file, dtype='<f4', mode='r', shape=(rows, dim))
+
+        if len(ids) > 1 and not np.all(ids[1:] > ids[:-1]):
+            raise ValueError(f'Vector store {path} ids are not strictly ascending')
+
+        return cls(path, ids=ids, vectors=vectors, dim=dim)
+
+    def append(self, ids, vectors):
+        ids = np.asarray(ids, dtype='<i8')
+        vectors = np.ascontiguousarray(vectors, dtype='<f4').reshape(len(ids), self.dim)
+
+        with open(os.path.join(self.path, 'ids.bin'), 'ab') as file:
+            file.write(ids.tobytes())
+        with open(os.path.join(self.path, 'vectors.bin'), 'ab') as file:
+            file.write(vectors.tobytes())
+
+    # Copy the store at path into target without the rows whose id falls in one of the inclusive (first, last)
+    # ranges, streaming the vectors. The files at path are only read, so a server that has them mapped keeps
+    # working; ids a crashed append wrote without their vector are dropped too. Returns the number of rows dropped.
+    @classmethod
+    def compact(cls, path, target, ranges, dim=768, chunk_size=65536):
+        os.makedirs(target, exist_ok=True)
+        ids_file = os.path.join(path, 'ids.bin')
+        vectors_file = os.path.join(path, 'vectors.bin')
+        ids = np.fromfile(ids_file, dtype='<i8') if os.path.exists(ids_file) else np.empty(0, dtype='<i8')
+        rows = min(len(ids), os.path.getsize(vectors_file) // (4 * dim)) if os.path.exists(vectors_file) else 0
+        keep = np.zeros(len(ids), dtype=bool)
+        keep[:rows] = True
+        for first, last in ranges:
+            keep &= (ids < first) | (ids > last)
+
+        vectors = np.memmap(vectors_file, dtype='<f4', mode='r', shape=(rows, dim)) if rows else np.empty((0, dim), dtype='<f4')
+        with open(os.path.join(target, 'vectors.bin'), 'wb') as file:
+            for start in range(0, rows, chunk_size):
+                file.write(np.ascontiguousarray(vectors[start:start + chunk_size][keep[start:start + chunk_size]]).tobytes())
+        del vectors
+
+        ids[keep].tofile(os.path.join(target, 'ids.bin'))
+        return int((~keep).sum())
+
+    def positions(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if len(self) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self) - 1)
+        return np.where(self.ids[positions] == ids, positions, -1)
+
+    def get(self, ids):
+        positions = self.positions(ids)
+        if np.any(positions < 0):
+            raise KeyError(f'Image ids not found: {np.asarray(ids)[positions < 0].tolist()}')
+        return np.asarray(self.vectors[positions])
+
+    # Exact inner products of the first-stage candidates, re-sorted and cut to k. Candidates missing from the
+    # store (faiss' -1 padding, or ids added after it was loaded) keep their approximate score.
+    def rerank(self, query_vectors, distances, indices, k):
+        positions = self.positions(indices).reshape(indices.shape)
+        found = positions >= 0
+        if not found.any():
+            return distances[:, :k], indices[:, :k]
+
+        candidates = np.asarray(self.vectors[np.where(found, positions, 0).ravel()], dtype=np.float32)
+        exact = np.einsum('qd,qcd->qc', np.asarray(query_vectors, dtype=np.float32), candidates.reshape(*indices.shape, -1))
+        scores = np.where(found, exact, distances).astype(np.float32)
+        order = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)